@@ -3,7 +3,13 @@
 Most of the code here is taken from the security tutorial for FastAPI found at:
 https://fastapi.tiangolo.com/tutorial/security/oauth2-jwt/
 """
+import asyncio
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 
@@ -13,6 +19,7 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from app import crud
 
@@ -21,9 +28,16 @@ from app import crud
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("HASH_ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Number of password hashes that can be computed at once
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+# Number of validated tokens whose claims are cached
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt is deliberately slow, so it runs on its own small pool rather than the event loop
+password_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
@@ -55,28 +69,80 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = crud.get_user_by_username(db, username)
+async def verify_password_async(plain_password, hashed_password):
+    """Verify a password on the password hashing pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_hash_executor, verify_password, plain_password, hashed_password)
+
+
+async def authenticate_user(db: Session, username: str, password: str):
+    user = await run_in_threadpool(crud.get_user_by_username, db, username)
     if not user:
         print(f"User{username} not in db")
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
         print("incorrect password")
         return False
     return user
 
 
+class TokenCache:
+    """LRU cache of the claims of validated tokens, keyed by a hash of the token.
+
+    Entries are only served until the token's exp claim, so a cached token expires exactly
+    when it would have failed validation.
+    """
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.lock = threading.Lock() # sync dependencies run on multiple threads
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[dict]:
+        """Return the cached claims of token, or None if it isn't cached or has expired."""
+        key = self._key(token)
+        with self.lock:
+            payload = self.entries.get(key)
+            if payload is None:
+                return None
+            if payload["exp"] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return payload
+
+    def put(self, token: str, payload: dict) -> None:
+        """Cache the claims of a validated token. Tokens without an exp claim are not cached."""
+        if "exp" not in payload:
+            return
+        key = self._key(token)
+        with self.lock:
+            self.entries[key] = payload
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+token_cache = TokenCache()
+
+
 def validate_token(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    if token_cache.get(token) is not None:
+        return
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
-        
+        token_cache.put(token, payload)
     except JWTError:
         raise credentials_exception
\ No newline at end of file
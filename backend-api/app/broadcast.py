@@ -0,0 +1,152 @@
+"""Fan-out hub for forwarding device events to websocket clients."""
+import asyncio
+import os
+from typing import Dict, Set
+
+from fastapi import WebSocket
+
+# Maximum number of messages buffered for a single websocket client
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "100"))
+# What to do when a client's buffer is full: "drop_oldest" or "disconnect"
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+# Close code sent to clients that are disconnected for falling behind
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class Subscriber:
+    """A single websocket client and its bounded queue of outbound messages."""
+
+    def __init__(self, device_id: str, websocket: WebSocket, max_queue_size: int, policy: str) -> None:
+        self.device_id = device_id
+        self.websocket = websocket
+        self.policy = policy
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+        self.closed = False
+        self._sender_task = None
+
+    def start(self) -> None:
+        """Start sending queued messages to the client in the background."""
+        self._sender_task = asyncio.create_task(self._send_loop())
+
+    def offer(self, message: str) -> bool:
+        """Queue a message for the client without waiting.
+
+        If the queue is full, the subscriber's slow consumer policy is applied: either the
+        oldest queued message is dropped to make room, or the client is disconnected.
+
+        Returns:
+            bool: False if the message could not be queued
+        """
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            if self.policy == DISCONNECT:
+                print(f"Disconnecting slow websocket client for {self.device_id}")
+                self.close(SLOW_CONSUMER_CLOSE_CODE)
+                return False
+            self.queue.get_nowait()
+            self.dropped += 1
+            self.queue.put_nowait(message)
+            return True
+
+    def close(self, code: int = 1000) -> None:
+        """Stop the sender and close the websocket."""
+        if self.closed:
+            return
+        self.closed = True
+        if self._sender_task is not None:
+            self._sender_task.cancel()
+        asyncio.create_task(self._close_websocket(code))
+
+    async def _close_websocket(self, code: int) -> None:
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            # Client is already gone
+            pass
+
+    async def _send_loop(self) -> None:
+        while True:
+            message = await self.queue.get()
+            try:
+                await self.websocket.send_text(message)
+            except Exception as e:
+                print(f"Failed to send to websocket client for {self.device_id}: {e}")
+                self.closed = True
+                return
+
+
+class BroadcastHub:
+    """Maps device IDs to the websocket clients waiting for updates for that device.
+
+    Publishing never waits on a client: each message is placed on every subscriber's own
+    bounded queue and a per-subscriber task delivers it, so a slow client can only fall
+    behind itself.
+    """
+
+    def __init__(self, max_queue_size: int = WS_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY) -> None:
+        if policy not in (DROP_OLDEST, DISCONNECT):
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+        self.subscribers: Dict[str, Set[Subscriber]] = {}
+
+    def subscribe(self, device_id: str, websocket: WebSocket) -> Subscriber:
+        """Register a websocket to receive updates for device_id and start its sender."""
+        subscriber = Subscriber(device_id, websocket, self.max_queue_size, self.policy)
+        self.subscribers.setdefault(device_id, set()).add(subscriber)
+        subscriber.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        """Remove a subscriber and stop its sender."""
+        device_subscribers = self.subscribers.get(subscriber.device_id)
+        if device_subscribers is not None:
+            device_subscribers.discard(subscriber)
+            if not device_subscribers:
+                del self.subscribers[subscriber.device_id]
+        subscriber.closed = True
+        if subscriber._sender_task is not None:
+            subscriber._sender_task.cancel()
+
+    def has_subscribers(self, device_id: str) -> bool:
+        """Return true if any client is waiting for updates for device_id."""
+        return device_id in self.subscribers
+
+    def publish(self, device_id: str, message: str) -> int:
+        """Queue message for every subscriber of device_id and return how many accepted it."""
+        device_subscribers = self.subscribers.get(device_id)
+        if not device_subscribers:
+            return 0
+        delivered = 0
+        for subscriber in list(device_subscribers):
+            if subscriber.offer(message):
+                delivered += 1
+            elif subscriber.closed:
+                self.unsubscribe(subscriber)
+        return delivered
+
+    def stats(self) -> dict:
+        """Return counts of connected clients, queued messages and dropped messages."""
+        num_subscribers = 0
+        queued = 0
+        dropped = 0
+        for device_subscribers in self.subscribers.values():
+            for subscriber in device_subscribers:
+                num_subscribers += 1
+                queued += subscriber.queue.qsize()
+                dropped += subscriber.dropped
+        return {
+            "devices": len(self.subscribers),
+            "subscribers": num_subscribers,
+            "queued": queued,
+            "dropped": dropped,
+        }
@@ -0,0 +1,81 @@
+"""Batched checkpointing for the Event Hub consumer."""
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+# Checkpoint a partition after this many events...
+CHECKPOINT_EVENTS = int(os.getenv("CHECKPOINT_EVENTS", "100"))
+# ...or after this many seconds, whichever comes first
+CHECKPOINT_SECONDS = float(os.getenv("CHECKPOINT_SECONDS", "10"))
+
+
+class PartitionCheckpoint:
+    """Uncommitted progress for a single partition."""
+
+    def __init__(self, partition_context) -> None:
+        self.partition_context = partition_context
+        self.last_event = None
+        self.pending_events = 0
+        self.last_checkpoint_time = time.monotonic()
+
+
+class BatchCheckpointer:
+    """Commits Event Hub checkpoints every max_events events or max_interval seconds per partition.
+
+    Checkpointing once per event costs a checkpoint store round trip per message. Instead, the
+    consumer records each processed event here and only the latest event of a partition is
+    committed once either threshold is crossed. Anything still pending is committed by flush().
+
+    If before_commit is given, it is awaited before every checkpoint, so work that must not be
+    lost (such as buffered database writes) can be finished before its events are committed.
+    """
+
+    def __init__(self, max_events: int = CHECKPOINT_EVENTS, max_interval: float = CHECKPOINT_SECONDS, before_commit: Optional[Callable[[], Awaitable[None]]] = None) -> None:
+        self.max_events = max_events
+        self.max_interval = max_interval
+        self.before_commit = before_commit
+        self.partitions: Dict[str, PartitionCheckpoint] = {}
+
+    async def record(self, partition_context, event=None, num_events: int = 1) -> None:
+        """Record that events were processed and checkpoint the partition if a threshold is crossed.
+
+        Args:
+            partition_context: context of the partition the events were received from
+            event: the last event processed, or None if no new events arrived
+            num_events: how many events were processed, ending with event
+        """
+        partition_id = partition_context.partition_id
+        partition = self.partitions.get(partition_id)
+        if partition is None:
+            partition = PartitionCheckpoint(partition_context)
+            self.partitions[partition_id] = partition
+        partition.partition_context = partition_context
+
+        if event is not None:
+            partition.last_event = event
+            partition.pending_events += num_events
+
+        elapsed = time.monotonic() - partition.last_checkpoint_time
+        if partition.pending_events >= self.max_events or (partition.pending_events > 0 and elapsed >= self.max_interval):
+            await self._commit(partition)
+
+    async def flush_partition(self, partition_id: str) -> None:
+        """Commit any pending checkpoint for a single partition."""
+        partition = self.partitions.pop(partition_id, None)
+        if partition is not None and partition.pending_events > 0:
+            await self._commit(partition)
+
+    async def flush(self) -> None:
+        """Commit pending checkpoints for every partition."""
+        for partition_id in list(self.partitions):
+            try:
+                await self.flush_partition(partition_id)
+            except Exception as e:
+                print(f"Failed to checkpoint partition {partition_id}: {e}")
+
+    async def _commit(self, partition: PartitionCheckpoint) -> None:
+        if self.before_commit is not None:
+            await self.before_commit()
+        await partition.partition_context.update_checkpoint(partition.last_event)
+        partition.pending_events = 0
+        partition.last_checkpoint_time = time.monotonic()
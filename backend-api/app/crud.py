@@ -1,6 +1,7 @@
 """Functions to perform CRUD operations on the database."""
-from typing import List
-from sqlalchemy import desc, func
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy import and_, desc, func, insert, literal_column, or_, select
 from sqlalchemy.orm import Session
 
 from app import models
@@ -11,16 +12,183 @@ def get_user_by_username(db: Session, username: str) -> models.User:
     return db.query(models.User).filter(models.User.username == username).first()
 
 
+def get_device_by_name(db: Session, device_name: str) -> models.Device:
+    """Return device with matching name."""
+    return db.query(models.Device).filter(models.Device.device_name == device_name).first()
+
+
 def get_top_visiting_birds(db: Session, limit: int = 10):
     """Return the top visiting birds and their visit count."""
+    num_visits = func.sum(models.SpeciesVisitCount.num_visits).label('num_visits')
     return db.query(
-        models.Bird.common_name,func.count(models.Bird.common_name).label('num_visits')
+        models.Bird.common_name, num_visits
         ).join(
-            models.Visit, models.Visit.visiting_bird==models.Bird.id
+            models.SpeciesVisitCount, models.SpeciesVisitCount.bird_id==models.Bird.id
         ).group_by(
             models.Bird.common_name
+        ).having(
+            num_visits > 0
         ).order_by(
             desc("num_visits"), models.Bird.common_name
         ).limit(
             limit
         ).all()
+
+
+def get_species_visit_counts(db: Session):
+    """Return every species and its total visit count across all devices, including species with no visits."""
+    return db.query(
+        models.Bird.common_name,
+        func.coalesce(func.sum(models.SpeciesVisitCount.num_visits), 0).label('num_visits')
+        ).outerjoin(
+            models.SpeciesVisitCount, models.SpeciesVisitCount.bird_id==models.Bird.id
+        ).group_by(
+            models.Bird.common_name
+        ).all()
+
+
+def get_top_visiting_birds_for_device(db: Session, device_id: int, limit: int = 10, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Return the top visiting birds at a device and their visit count.
+
+    All-time counts come from species_visit_counts. If start or end is given, visits in
+    [start, end) are counted instead, using the (device_id, visited_at) index.
+    """
+    if start is None and end is None:
+        return db.query(
+            models.Bird.common_name, models.SpeciesVisitCount.num_visits
+            ).join(
+                models.SpeciesVisitCount, models.SpeciesVisitCount.bird_id==models.Bird.id
+            ).filter(
+                models.SpeciesVisitCount.device_id == device_id,
+                models.SpeciesVisitCount.num_visits > 0
+            ).order_by(
+                desc(models.SpeciesVisitCount.num_visits), models.Bird.common_name
+            ).limit(
+                limit
+            ).all()
+
+    query = db.query(
+        models.Bird.common_name, func.count(models.Visit.id).label('num_visits')
+        ).join(
+            models.Visit, models.Visit.visiting_bird==models.Bird.id
+        ).filter(
+            models.Visit.device_id == device_id
+        )
+    if start is not None:
+        query = query.filter(models.Visit.visited_at >= start)
+    if end is not None:
+        query = query.filter(models.Visit.visited_at < end)
+    return query.group_by(
+            models.Bird.common_name
+        ).order_by(
+            desc("num_visits"), models.Bird.common_name
+        ).limit(
+            limit
+        ).all()
+
+
+def get_visit_stats(db: Session, device_id: int, start: datetime, end: datetime, bucket: str = "day"):
+    """Return (bucket start, species, visit count) rows for visits to a device in [start, end).
+
+    Visits are grouped by species and by the hour or day they occurred in. Only the
+    (device_id, visited_at) index is read, since it includes visiting_bird.
+    """
+    # Literals rather than bound parameters, so SQL Server sees the same expression in SELECT and GROUP BY
+    datepart = literal_column(bucket)
+    epoch = literal_column("0")
+    bucket_start = func.dateadd(datepart, func.datediff(datepart, epoch, models.Visit.visited_at), epoch).label('bucket_start')
+    counts = db.query(
+        bucket_start, models.Visit.visiting_bird, func.count().label('num_visits')
+        ).filter(
+            models.Visit.device_id == device_id,
+            models.Visit.visited_at >= start,
+            models.Visit.visited_at < end
+        ).group_by(
+            bucket_start, models.Visit.visiting_bird
+        ).subquery()
+    return db.query(
+        counts.c.bucket_start, models.Bird.common_name, counts.c.num_visits
+        ).join(
+            models.Bird, models.Bird.id==counts.c.visiting_bird
+        ).order_by(
+            counts.c.bucket_start, models.Bird.common_name
+        ).all()
+
+
+def _visit_history_query(device_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Return a select of a device's visits in [start, end), newest first."""
+    query = select(
+        models.Visit.id,
+        models.Bird.common_name,
+        models.Visit.visited_at,
+        models.Visit.latitude,
+        models.Visit.longitude
+        ).join(
+            models.Bird, models.Bird.id==models.Visit.visiting_bird
+        ).where(
+            models.Visit.device_id == device_id
+        ).order_by(
+            desc(models.Visit.visited_at), desc(models.Visit.id)
+        )
+    if start is not None:
+        query = query.where(models.Visit.visited_at >= start)
+    if end is not None:
+        query = query.where(models.Visit.visited_at < end)
+    return query
+
+
+def get_visit_history(db: Session, device_id: int, limit: int = 100, after: Optional[tuple] = None, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Return one page of a device's visits, newest first.
+
+    Pages are keyed on (visited_at, id) rather than an offset: after is the (visited_at, id)
+    of the last visit on the previous page, and only older visits are returned.
+    """
+    query = _visit_history_query(device_id, start, end)
+    if after is not None:
+        after_visited_at, after_id = after
+        query = query.where(or_(
+            models.Visit.visited_at < after_visited_at,
+            and_(models.Visit.visited_at == after_visited_at, models.Visit.id < after_id)
+        ))
+    return db.execute(query.limit(limit)).all()
+
+
+def stream_visit_history(db: Session, device_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None, batch_size: int = 1000):
+    """Yield every visit to a device in [start, end), newest first, fetching batch_size rows at a time.
+
+    Rows are read from the cursor as they are needed, so the result set is never held in memory.
+    """
+    result = db.execute(_visit_history_query(device_id, start, end).execution_options(stream_results=True))
+    for partition in result.partitions(batch_size):
+        yield from partition
+
+
+def get_bird_ids(db: Session) -> dict:
+    """Return a dict mapping each species' common name to its ID."""
+    return dict(db.query(models.Bird.common_name, models.Bird.id).all())
+
+
+def get_device_ids(db: Session) -> dict:
+    """Return a dict mapping each device's name to its ID."""
+    return dict(db.query(models.Device.device_name, models.Device.id).all())
+
+
+def get_max_ingest_position(db: Session, partition_id: str) -> tuple:
+    """Return the highest (sequence number, batch index) stored for an Event Hub partition, or (-1, -1) if there is none."""
+    position = db.query(
+        models.Visit.sequence_number, models.Visit.batch_index
+        ).filter(
+            models.Visit.partition_id == partition_id
+        ).order_by(
+            desc(models.Visit.sequence_number), desc(models.Visit.batch_index)
+        ).first()
+    return (-1, -1) if position is None else tuple(position)
+
+
+def create_visits(db: Session, visits: List[dict]) -> None:
+    """Insert visits with a single executemany. The caller commits.
+
+    The insert is inline, so even a single visit is inserted without fetching its generated ID
+    through an OUTPUT clause, which SQL Server rejects on the triggered visits table.
+    """
+    db.execute(insert(models.Visit.__table__).inline(), visits)
@@ -1,16 +1,26 @@
 """Database connection for API."""
 import os
+import threading
+import time
 
 import pyodbc
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine import URL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
-## Disable pooling in pyodbc
+## Disable pooling in pyodbc - connections are pooled by SQLAlchemy instead (see below)
 pyodbc.pooling = False 
 
-## Create database engine
+## Connection pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10")) # connections kept open
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10")) # extra connections opened under load and closed afterward
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30")) # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800")) # seconds before a connection is replaced, below Azure SQL's idle timeout
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true" # test connections before handing them out
+
+## Database connection settings
 DB_SERVER = os.getenv("DB_SERVER")
 DB_NAME = os.getenv("DB_NAME")
 DB_USERNAME = os.getenv("DB_USERNAME")
@@ -19,7 +29,87 @@ DB_DRIVER = os.getenv("DB_DRIVER")
 DB_PORT = os.getenv("DB_PORT")
 connection_string = 'DRIVER='+DB_DRIVER+';SERVER=tcp:'+DB_SERVER+';PORT='+DB_PORT+';DATABASE='+DB_NAME+';UID='+DB_USERNAME+';PWD='+DB_PASSWORD
 connection_url = URL.create("mssql+pyodbc", query={"odbc_connect": connection_string})
-engine = create_engine(connection_url)
+
+## Pool metrics
+class PoolMetrics:
+    """Counts connection pool activity using pool events."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.waits = 0 # checkouts made while every pooled and overflow connection was in use
+        self.wait_seconds = 0.0 # total time spent in those checkouts
+        self.invalidations = 0
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.invalidations += 1
+
+    def record_wait(self, seconds: float):
+        with self.lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+
+    def stats(self, pool) -> dict:
+        """Return the pool's current state and the event counts."""
+        with self.lock:
+            return {
+                "size": pool.size(),
+                "checkedOut": pool.checkedout(),
+                "checkedIn": pool.checkedin(),
+                "overflow": max(pool.overflow(), 0),
+                "maxOverflow": DB_MAX_OVERFLOW,
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "waitSeconds": self.wait_seconds,
+                "invalidations": self.invalidations,
+            }
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records checkouts which had to wait for a connection to be returned."""
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kw):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kw)
+        # A max_overflow of -1 allows any number of overflow connections, so checkouts never wait
+        self.overflow_limit = None if max_overflow < 0 else max_overflow
+
+    def _do_get(self):
+        exhausted = self.overflow_limit is not None and self.checkedin() == 0 and self.overflow() >= self.overflow_limit
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            if exhausted:
+                pool_metrics.record_wait(time.monotonic() - start)
+
+
+## Create database engine
+engine = create_engine(
+    connection_url,
+    poolclass=InstrumentedQueuePool,
+    fast_executemany=True, # send executemany parameters in bulk
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
+event.listen(engine, "connect", pool_metrics.on_connect)
+event.listen(engine, "checkout", pool_metrics.on_checkout)
+event.listen(engine, "invalidate", pool_metrics.on_invalidate)
 
 ## Session factory
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False) # why autoflush=False?
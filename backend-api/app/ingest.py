@@ -0,0 +1,167 @@
+"""Buffered ingestion of bird_visits events into the visits table."""
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+from app import crud
+
+# Set to "true" to store bird_visits events in the database from the backend
+INGEST_VISITS = os.getenv("INGEST_VISITS", "false").lower() == "true"
+# Write buffered visits after this many have been received...
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+# ...or after this many milliseconds, whichever comes first
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "1000"))
+# Maximum number of visits held in memory while the database is unavailable
+INGEST_MAX_BUFFER = int(os.getenv("INGEST_MAX_BUFFER", "50000"))
+# Seconds before the bird and device lookups are reloaded after a name isn't found
+LOOKUP_REFRESH_SECONDS = 60
+
+
+class NameLookup:
+    """Cached mapping from names to database IDs, reloaded at most once per refresh interval on a miss."""
+
+    def __init__(self, loader, refresh_seconds: float = LOOKUP_REFRESH_SECONDS) -> None:
+        self.loader = loader
+        self.refresh_seconds = refresh_seconds
+        self.ids: Dict[str, int] = {}
+        self.loaded_at: Optional[float] = None
+
+    def get(self, db, name: str) -> Optional[int]:
+        """Return the ID for name, or None if it is unknown."""
+        if name not in self.ids and (self.loaded_at is None or time.monotonic() - self.loaded_at >= self.refresh_seconds):
+            self.ids = self.loader(db)
+            self.loaded_at = time.monotonic()
+        return self.ids.get(name)
+
+
+class VisitIngestor:
+    """Buffers bird_visits events and writes them to the database in batches.
+
+    Each visit is stored with the partition ID and sequence number of the event it came from,
+    plus its index within the event for events holding a batch of visits. Sequence numbers only
+    increase within a partition, so visits at or below the highest (sequence number, batch index)
+    already stored for a partition are skipped. This makes replays after a missed checkpoint
+    harmless.
+    """
+
+    def __init__(self, session_factory, batch_size: int = INGEST_BATCH_SIZE, flush_interval_ms: int = INGEST_FLUSH_MS, max_buffer: int = INGEST_MAX_BUFFER) -> None:
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_buffer = max_buffer
+        self.buffer: List[dict] = []
+        self.lock = asyncio.Lock()
+        self.birds = NameLookup(crud.get_bird_ids)
+        self.devices = NameLookup(crud.get_device_ids)
+        self.max_positions: Dict[str, tuple] = {} # partition ID -> highest (sequence number, batch index) stored
+        self.stored = 0
+        self.skipped = 0
+
+    async def add(self, partition_id: str, sequence_number: int, visit: dict, batch_index: int = 0) -> None:
+        """Buffer a visit from a bird_visits event, writing the buffer if it is full."""
+        self.buffer.append({"partition_id": partition_id, "position": (sequence_number, batch_index), "visit": visit})
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+
+    def forget_partition(self, partition_id: str) -> None:
+        """Reload the highest stored sequence number of a partition before its next write.
+
+        Called when this consumer takes ownership of a partition, since another consumer may
+        have stored visits from it in the meantime.
+        """
+        self.max_positions.pop(partition_id, None)
+
+    async def flush(self) -> None:
+        """Write every buffered visit to the database.
+
+        If the write fails, the visits are returned to the buffer and the exception is raised.
+        """
+        async with self.lock:
+            if not self.buffer:
+                return
+            pending, self.buffer = self.buffer, []
+            try:
+                await run_in_threadpool(self._write, pending)
+            except Exception:
+                self.buffer = pending + self.buffer
+                if len(self.buffer) > self.max_buffer:
+                    dropped = len(self.buffer) - self.max_buffer
+                    print(f"Visit buffer full - dropping {dropped} oldest visits")
+                    self.buffer = self.buffer[dropped:]
+                raise
+
+    async def run(self) -> None:
+        """Write buffered visits every flush interval."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Failed to store visits: {e}")
+
+    def _write(self, pending: List[dict]) -> None:
+        db = self.session_factory()
+        try:
+            try:
+                self._insert(db, pending)
+            except IntegrityError:
+                # Another consumer stored some of these visits - reload and try again
+                db.rollback()
+                for item in pending:
+                    self.forget_partition(item["partition_id"])
+                self._insert(db, pending)
+        finally:
+            db.close()
+
+    def _insert(self, db, pending: List[dict]) -> None:
+        max_positions = dict(self.max_positions)
+        rows = []
+        for item in pending:
+            partition_id = item["partition_id"]
+            if partition_id not in max_positions:
+                max_positions[partition_id] = crud.get_max_ingest_position(db, partition_id)
+            if item["position"] <= max_positions[partition_id]:
+                # Already stored
+                continue
+            row = self._to_row(db, item)
+            max_positions[partition_id] = item["position"]
+            if row is not None:
+                rows.append(row)
+
+        if rows:
+            crud.create_visits(db, rows)
+            db.commit()
+        self.max_positions = max_positions
+        self.stored += len(rows)
+        self.skipped += len(pending) - len(rows)
+
+    def _to_row(self, db, item: dict) -> Optional[dict]:
+        visit = item["visit"]
+        try:
+            bird_id = self.birds.get(db, visit["visiting_bird"])
+            device_id = self.devices.get(db, visit["device_id"])
+            if bird_id is None or device_id is None:
+                print(f"Skipping visit from unknown species or device: {visit['visiting_bird']}, {visit['device_id']}")
+                return None
+            return {
+                "visiting_bird": bird_id,
+                "device_id": device_id,
+                "visited_at": datetime.fromisoformat(visit["visited_at"]),
+                "latitude": visit["latitude"],
+                "longitude": visit["longitude"],
+                "partition_id": item["partition_id"],
+                "sequence_number": item["position"][0],
+                "batch_index": item["position"][1],
+            }
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Skipping malformed visit {visit}: {e}")
+            return None
+
+    def stats(self) -> dict:
+        """Return counts of buffered, stored and skipped visits."""
+        return {"buffered": len(self.buffer), "stored": self.stored, "skipped": self.skipped}
@@ -0,0 +1,66 @@
+"""In-memory ranking of the most frequently visiting bird species."""
+import os
+from typing import Dict, Iterable, List, Tuple
+
+# Seconds between reloads of the leaderboard from the species_visit_counts table
+LEADERBOARD_REFRESH_SECONDS = float(os.getenv("LEADERBOARD_REFRESH_SECONDS", "300"))
+
+
+class SpeciesLeaderboard:
+    """Species ranked by visit count, updated one visit at a time.
+
+    Species are kept sorted by descending visit count and then by name, which is the order
+    the /visits/topSpecies endpoint returns. Recording a visit only moves the visited species
+    past the species it overtakes, and reading the top K is a slice of the ranking, so neither
+    depends on how many visits have been stored.
+    """
+
+    def __init__(self) -> None:
+        self.ranking: List[str] = []       # species names, highest count first
+        self.positions: Dict[str, int] = {} # species name -> index in ranking
+        self.counts: Dict[str, int] = {}    # species name -> number of visits
+        self.loaded = False
+
+    def load(self, counts: Iterable[Tuple[str, int]]) -> None:
+        """Replace the ranking with (common name, visit count) pairs, e.g. from the database.
+
+        Every known species should be included, even with a count of zero, since visits
+        from species that aren't in the ranking are ignored.
+        """
+        self.counts = {common_name: int(num_visits) for common_name, num_visits in counts}
+        self.ranking = sorted(self.counts, key=self._sort_key)
+        self.positions = {common_name: i for i, common_name in enumerate(self.ranking)}
+        self.loaded = True
+
+    def record_visit(self, common_name: str) -> bool:
+        """Count a visit from common_name.
+
+        Returns:
+            bool: False if the species is unknown, in which case nothing is counted
+        """
+        if common_name not in self.counts:
+            return False
+        self.counts[common_name] += 1
+
+        # Move the species ahead of any species it now ranks above
+        position = self.positions[common_name]
+        key = self._sort_key(common_name)
+        while position > 0 and key < self._sort_key(self.ranking[position - 1]):
+            previous = self.ranking[position - 1]
+            self.ranking[position] = previous
+            self.positions[previous] = position
+            position -= 1
+        self.ranking[position] = common_name
+        self.positions[common_name] = position
+        return True
+
+    def top(self, limit: int = 10) -> List[dict]:
+        """Return the limit most frequent visitors and their visit counts."""
+        return [
+            {"common_name": common_name, "num_visits": self.counts[common_name]}
+            for common_name in self.ranking[:max(limit, 0)]
+            if self.counts[common_name] > 0
+        ]
+
+    def _sort_key(self, common_name: str) -> Tuple[int, str]:
+        return (-self.counts[common_name], common_name)
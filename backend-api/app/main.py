@@ -1,25 +1,44 @@
 import asyncio
+import base64
+import csv
+import gzip
+import io
+import json
 import os
-from typing import List
+from typing import List, Optional
 
 from azure.eventhub.aio import EventHubConsumerClient
-from azure.iot.hub import IoTHubRegistryManager
 from azure.iot.hub.models import Twin, TwinProperties
-from fastapi import Depends, FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import Depends, FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from msrest.exceptions import HttpOperationError
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordRequestForm
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 
-from app.database import Base, SessionLocal, engine
+from app.database import Base, SessionLocal, engine, pool_metrics
 from app import schemas, crud, auth
+from app.broadcast import BroadcastHub
+from app.checkpoint import BatchCheckpointer, CHECKPOINT_SECONDS
+from app.ingest import VisitIngestor, INGEST_VISITS
+from app.leaderboard import SpeciesLeaderboard, LEADERBOARD_REFRESH_SECONDS
+from app.registry import AsyncRegistry, twin_property_name
+from app.twin_cache import TwinCache
 
 # Configuration
 EVENT_CONNECTION_STR = os.getenv("EVENT_CONNECTION_STR")
 REGISTRY_CONNECTION_STR = os.getenv("REGISTRY_CONNECTION_STR")
 EVENTHUB_NAME = os.getenv("EVENTHUB_NAME")
 CONSUMER_GROUP = os.getenv("CONSUMER_GROUP")
+ANALYZER_EDGE_DEVICE_ID = os.getenv("ANALYZER_EDGE_DEVICE_ID") # edge device running ObjectDetectionAnalyzer
+ANALYZER_MODULE_ID = os.getenv("ANALYZER_MODULE_ID", "ObjectDetectionAnalyzer")
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "300"))
+MAX_BULK_DEVICES = int(os.getenv("MAX_BULK_DEVICES", "100"))
+MAX_STATS_DAYS = int(os.getenv("MAX_STATS_DAYS", "366"))
+MAX_HISTORY_PAGE_SIZE = int(os.getenv("MAX_HISTORY_PAGE_SIZE", "1000"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
 
 # App
 app = FastAPI()
@@ -36,18 +55,124 @@ def get_db():
         db.close()
 
 
+@app.get("/database/pool/stats", dependencies=[Depends(auth.validate_token)])
+def get_pool_stats():
+    return pool_metrics.stats(engine.pool)
+
+
+# Leaderboard
+leaderboard = SpeciesLeaderboard() # visit counts per species, updated from the bird_visits stream
+
+def read_species_visit_counts():
+    db = SessionLocal()
+    try:
+        return crud.get_species_visit_counts(db)
+    finally:
+        db.close()
+
+async def refresh_leaderboard():
+    """Periodically reload the leaderboard from the database to correct any drift from the stream."""
+    while True:
+        try:
+            leaderboard.load(await run_in_threadpool(read_species_visit_counts))
+        except Exception as e:
+            print(f"Failed to load species visit counts: {e}")
+        await asyncio.sleep(LEADERBOARD_REFRESH_SECONDS)
+
+leaderboard_task = asyncio.create_task(refresh_leaderboard())
+
+
 # Websocket
-websockets = {} # maps device IDs to websocket clients waiting for updates for that device
-
-async def on_event(partition_context, event):
-    event_body = event.body_as_json()
-    if "device_id" in event_body:
-        device_id = event_body["device_id"]
-        if device_id in websockets:
-            websocket = websockets[device_id]
-            print("Forwarding event to client.")
-            await websocket.send_text(event.body_as_str())
-    await partition_context.update_checkpoint(event)
+broadcast_hub = BroadcastHub() # maps device IDs to websocket clients waiting for updates for that device
+
+
+# Visit ingestion
+visit_ingestor = VisitIngestor(SessionLocal) if INGEST_VISITS else None
+ingest_task = asyncio.create_task(visit_ingestor.run()) if visit_ingestor is not None else None
+
+
+# Event Hub consumer
+checkpointer = BatchCheckpointer(before_commit=visit_ingestor.flush if visit_ingestor is not None else None)
+
+async def route_event(partition_context, event):
+    """Forward a single event to the clients waiting on its device and store it if it is a visit."""
+    system_properties = event.system_properties
+    if system_properties.get(b"iothub-message-source") == b"twinChangeEvents":
+        handle_twin_change(system_properties, event)
+        return
+    if (event.properties or {}).get(b"message-type") == b"foodLevelHistory":
+        route_food_level_history(system_properties, event)
+        return
+    batch_encoding = (event.properties or {}).get(b"batch-encoding")
+    if batch_encoding is not None:
+        await route_visit_batch(partition_context, event, batch_encoding)
+        return
+    try:
+        event_body = event.body_as_json()
+    except (TypeError, ValueError):
+        print("Skipping event with a body that is not valid JSON.")
+        return
+    await route_message(partition_context, event.sequence_number, 0, event_body, event.body_as_str())
+
+async def route_visit_batch(partition_context, event, batch_encoding):
+    """Unpack a message holding a JSON array of visits and route each visit as if it had arrived on its own."""
+    try:
+        body = b"".join(event.body)
+        if batch_encoding == b"gzip":
+            body = gzip.decompress(body)
+        visits = json.loads(body)
+    except (OSError, EOFError, ValueError):
+        print("Skipping visit batch that could not be decoded.")
+        return
+    if not isinstance(visits, list):
+        print("Skipping visit batch that is not a JSON array.")
+        return
+    for batch_index, visit in enumerate(visits):
+        await route_message(partition_context, event.sequence_number, batch_index, visit, json.dumps(visit))
+
+async def route_message(partition_context, sequence_number, batch_index, message_body, message_str):
+    if "visiting_bird" in message_body:
+        leaderboard.record_visit(message_body["visiting_bird"])
+        if visit_ingestor is not None:
+            await visit_ingestor.add(partition_context.partition_id, sequence_number, message_body, batch_index)
+    if "device_id" in message_body:
+        device_id = message_body["device_id"]
+        broadcast_hub.publish(device_id, message_str)
+
+def route_food_level_history(system_properties, event):
+    """Forward food levels a feeder measured while it was offline to the clients waiting on it."""
+    device_id = system_properties.get(b"iothub-connection-device-id")
+    if device_id is None:
+        return
+    broadcast_hub.publish(device_id.decode(), event.body_as_str())
+
+def handle_twin_change(system_properties, event):
+    """Keep the twin cache in sync with reported property changes."""
+    device_id = system_properties.get(b"iothub-connection-device-id")
+    if device_id is None:
+        return
+    device_id = device_id.decode()
+    try:
+        twin_change = event.body_as_json()
+        reported_patch = twin_change["properties"]["reported"]
+    except (TypeError, ValueError, KeyError):
+        # Not a reported property change we can apply - reload on next read
+        twin_cache.invalidate(device_id)
+        return
+    twin_cache.apply_patch(device_id, reported_patch)
+
+async def on_event_batch(partition_context, events):
+    for event in events:
+        await route_event(partition_context, event)
+    # Called with an empty batch after max_wait_time, so time-based checkpoints still happen when idle
+    await checkpointer.record(partition_context, events[-1] if events else None, len(events))
+
+async def on_partition_initialize(partition_context):
+    if visit_ingestor is not None:
+        visit_ingestor.forget_partition(partition_context.partition_id)
+
+async def on_partition_close(partition_context, reason):
+    await checkpointer.flush_partition(partition_context.partition_id)
 
 async def receive():
     consumer_client = EventHubConsumerClient.from_connection_string(
@@ -56,12 +181,31 @@ async def receive():
         eventhub_name=EVENTHUB_NAME,
     )
     async with consumer_client:
-        await consumer_client.receive(
-            on_event=on_event,
-            starting_position="@latest",  # "-1" is from the beginning of the partition.
-        )
+        try:
+            await consumer_client.receive_batch(
+                on_event_batch=on_event_batch,
+                on_partition_initialize=on_partition_initialize,
+                on_partition_close=on_partition_close,
+                max_batch_size=EVENT_BATCH_SIZE,
+                max_wait_time=CHECKPOINT_SECONDS,
+                starting_position="@latest",  # "-1" is from the beginning of the partition.
+            )
+        finally:
+            await checkpointer.flush()
 
-asyncio.create_task(receive())
+receive_task = asyncio.create_task(receive())
+
+@app.on_event("shutdown")
+async def stop_receiving():
+    leaderboard_task.cancel()
+    receive_task.cancel()
+    try:
+        await receive_task
+    except asyncio.CancelledError:
+        pass
+    if visit_ingestor is not None:
+        ingest_task.cancel()
+        await visit_ingestor.flush()
 
 # CORS
 app.add_middleware(
@@ -73,56 +217,279 @@ app.add_middleware(
 )
 
 # IoT Hub Registry Client
-hub_registry_manager = IoTHubRegistryManager.from_connection_string(REGISTRY_CONNECTION_STR)
+registry = AsyncRegistry(REGISTRY_CONNECTION_STR)
+
+async def load_reported_properties(device_id: str) -> dict:
+    twin = await registry.get_twin(device_id)
+    return twin.properties.reported
+
+twin_cache = TwinCache(load_reported_properties)
+
+@app.on_event("shutdown")
+def stop_registry():
+    registry.shutdown()
+
+REGISTRY_TIMEOUT_EXCEPTION = HTTPException(status_code=504, detail="Timed out waiting for IoT Hub registry")
 
 # Routes
+@app.get("/devices/foodLevel", dependencies=[Depends(auth.validate_token)])
+async def get_food_levels(ids: str):
+    """Return the food levels of several devices, given as a comma-separated list of IDs."""
+    device_ids = list(dict.fromkeys(id.strip() for id in ids.split(",") if id.strip()))
+    if len(device_ids) > MAX_BULK_DEVICES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_DEVICES} devices can be requested at once")
+    results = await asyncio.gather(*(twin_cache.get_reported(id) for id in device_ids), return_exceptions=True)
+    food_levels = {}
+    errors = {}
+    for device_id, result in zip(device_ids, results):
+        if isinstance(result, HttpOperationError):
+            errors[device_id] = result.response.reason
+        elif isinstance(result, asyncio.TimeoutError):
+            errors[device_id] = REGISTRY_TIMEOUT_EXCEPTION.detail
+        elif isinstance(result, Exception):
+            raise result
+        elif "foodLevel" not in result:
+            errors[device_id] = "Food level not reported"
+        else:
+            food_levels[device_id] = result["foodLevel"]
+    return {"foodLevels": food_levels, "errors": errors}
+
+
 @app.get("/devices/{device_id}/foodLevel", dependencies=[Depends(auth.validate_token)])
-def getFoodLevel(device_id: str):
+async def getFoodLevel(device_id: str):
     try:
-        twin = hub_registry_manager.get_twin(device_id)
-        return {"foodLevel": twin.properties.reported["foodLevel"]}
+        reported = await twin_cache.get_reported(device_id)
+        return {"foodLevel": reported["foodLevel"]}
     except HttpOperationError as e:
         raise HTTPException(status_code=e.response.status_code, detail=e.response.reason)
+    except asyncio.TimeoutError:
+        raise REGISTRY_TIMEOUT_EXCEPTION
 
 
 @app.get("/devices/{device_id}/unwelcomeVisitors", dependencies=[Depends(auth.validate_token)])
-def read_device_unwelcome_visitors(device_id: str):
+async def read_device_unwelcome_visitors(device_id: str):
     try:
-        twin = hub_registry_manager.get_twin(device_id)
-        return {"unwelcomeVisitors": twin.properties.reported["unwelcomeVisitors"]}
+        reported = await twin_cache.get_reported(device_id)
+        return {"unwelcomeVisitors": reported["unwelcomeVisitors"]}
     except HttpOperationError as e:
         raise HTTPException(status_code=e.response.status_code, detail=e.response.reason)
+    except asyncio.TimeoutError:
+        raise REGISTRY_TIMEOUT_EXCEPTION
 
 
 @app.post("/devices/{device_id}/unwelcomeVisitors", dependencies=[Depends(auth.validate_token)])
-def update_device_unwelcome_visitors(device_id: str, unwelcome_visitors: schemas.UnwelcomeVisitorList):
+async def update_device_unwelcome_visitors(device_id: str, unwelcome_visitors: schemas.UnwelcomeVisitorList):
     try:
         twin_patch = Twin()
         twin_patch.properties = TwinProperties(desired=unwelcome_visitors.dict())
-        updated_twin = hub_registry_manager.update_twin(device_id, twin_patch)
+        updated_twin = await registry.update_twin(device_id, twin_patch)
+        if ANALYZER_EDGE_DEVICE_ID:
+            # Let the analyzer filter out welcome visitors without asking the feeder
+            module_twin_patch = Twin()
+            module_twin_patch.properties = TwinProperties(desired={"unwelcomeVisitors": {twin_property_name(device_id): unwelcome_visitors.unwelcomeVisitors}})
+            await registry.update_module_twin(ANALYZER_EDGE_DEVICE_ID, ANALYZER_MODULE_ID, module_twin_patch)
         return updated_twin.properties.desired
     except HttpOperationError as e:
         raise HTTPException(status_code=e.response.status_code, detail=e.response.reason)
+    except asyncio.TimeoutError:
+        raise REGISTRY_TIMEOUT_EXCEPTION
 
 
 @app.websocket("/ws/{device_id}")
 async def websocket_endpoint(websocket: WebSocket, device_id: str):
     await websocket.accept()
     print(f"Accepted connection for {device_id}")
-    websockets[device_id] = websocket
+    subscriber = broadcast_hub.subscribe(device_id, websocket)
     try:
         while True:
             await websocket.receive_text() # detect when client disconnects
     except WebSocketDisconnect:
-        del websockets[device_id]
+        pass
+    finally:
+        broadcast_hub.unsubscribe(subscriber)
+
+
+@app.get("/websockets/stats", dependencies=[Depends(auth.validate_token)])
+def get_websocket_stats():
+    return broadcast_hub.stats()
+
+
+@app.get("/devices/twinCache/stats", dependencies=[Depends(auth.validate_token)])
+def get_twin_cache_stats():
+    return twin_cache.stats()
+
+
+@app.get("/visits/ingest/stats", dependencies=[Depends(auth.validate_token)])
+def get_ingest_stats():
+    if visit_ingestor is None:
+        raise HTTPException(status_code=404, detail="Visit ingestion is disabled")
+    return visit_ingestor.stats()
 
 
 @app.get("/visits/topSpecies", dependencies=[Depends(auth.validate_token)])
 def get_top_species(limit: int = 10, db: Session = Depends(get_db)):
+    if leaderboard.loaded:
+        return {"topSpecies": leaderboard.top(limit)}
     top_species = crud.get_top_visiting_birds(db=db, limit=limit)
     return {"topSpecies": top_species}
 
 
+def to_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Return a query time as naive UTC, like the visit times stored in the database.
+
+    Times with a UTC offset are converted to UTC; naive times are taken to be UTC already.
+    """
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def get_device_or_404(db: Session, device_name: str):
+    db_device = crud.get_device_by_name(db=db, device_name=device_name)
+    if db_device is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+    return db_device
+
+
+@app.get("/devices/{device_id}/visits/stats", response_model=schemas.VisitStats, dependencies=[Depends(auth.validate_token)])
+def get_device_visit_stats(
+    device_id: str,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    bucket: schemas.StatsBucket = schemas.StatsBucket.day,
+    db: Session = Depends(get_db),
+):
+    """Return visit counts per species per hour or day, for visits in [from, to). Defaults to the last 30 days."""
+    start, end = to_naive_utc(start), to_naive_utc(end)
+    if end is None:
+        end = datetime.utcnow()
+    if start is None:
+        start = end - timedelta(days=30)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="'from' must be earlier than 'to'")
+    if end - start > timedelta(days=MAX_STATS_DAYS):
+        raise HTTPException(status_code=400, detail=f"At most {MAX_STATS_DAYS} days can be requested at once")
+    db_device = get_device_or_404(db, device_id)
+    buckets = {}
+    for bucket_start, common_name, num_visits in crud.get_visit_stats(db=db, device_id=db_device.id, start=start, end=end, bucket=bucket.value):
+        buckets.setdefault(bucket_start, {})[common_name] = num_visits
+    return {
+        "deviceId": device_id,
+        "bucket": bucket,
+        "start": start,
+        "end": end,
+        "buckets": [{"start": bucket_start, "counts": counts} for bucket_start, counts in buckets.items()],
+    }
+
+
+@app.get("/devices/{device_id}/visits/topSpecies", dependencies=[Depends(auth.validate_token)])
+def get_device_top_species(
+    device_id: str,
+    limit: int = 10,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    db: Session = Depends(get_db),
+):
+    start, end = to_naive_utc(start), to_naive_utc(end)
+    db_device = get_device_or_404(db, device_id)
+    top_species = crud.get_top_visiting_birds_for_device(db=db, device_id=db_device.id, limit=limit, start=start, end=end)
+    return {"topSpecies": top_species}
+
+
+def encode_cursor(visited_at: datetime, visit_id: int) -> str:
+    """Encode the position of a visit in the history as an opaque cursor."""
+    return base64.urlsafe_b64encode(f"{visited_at.isoformat()}|{visit_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Return the (visited_at, id) encoded in a cursor."""
+    try:
+        visited_at, visit_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return to_naive_utc(datetime.fromisoformat(visited_at)), int(visit_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def visit_record(row) -> dict:
+    return {
+        "id": row.id,
+        "visiting_bird": row.common_name,
+        "visited_at": row.visited_at.isoformat(),
+        "latitude": float(row.latitude),
+        "longitude": float(row.longitude),
+    }
+
+
+@app.get("/devices/{device_id}/visits", response_model=schemas.VisitPage, dependencies=[Depends(auth.validate_token)])
+def get_device_visits(
+    device_id: str,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    db: Session = Depends(get_db),
+):
+    """Return a page of a device's visits, newest first. Pass nextCursor as cursor to get the next page."""
+    if limit < 1 or limit > MAX_HISTORY_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_HISTORY_PAGE_SIZE}")
+    after = decode_cursor(cursor) if cursor is not None else None
+    start, end = to_naive_utc(start), to_naive_utc(end)
+    db_device = get_device_or_404(db, device_id)
+    rows = crud.get_visit_history(db=db, device_id=db_device.id, limit=limit, after=after, start=start, end=end)
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_cursor(rows[-1].visited_at, rows[-1].id)
+    return {"visits": [visit_record(row) for row in rows], "nextCursor": next_cursor}
+
+
+def export_visits(device_id: int, start: Optional[datetime], end: Optional[datetime], format: str):
+    """Yield a device's visits as NDJSON lines or CSV rows, one database batch at a time."""
+    db = SessionLocal()
+    try:
+        rows = crud.stream_visit_history(db=db, device_id=device_id, start=start, end=end, batch_size=EXPORT_BATCH_SIZE)
+        if format == "csv":
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=list(schemas.VisitRecord.__fields__))
+            writer.writeheader()
+            for i, row in enumerate(rows, start=1):
+                writer.writerow(visit_record(row))
+                if i % EXPORT_BATCH_SIZE == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        else:
+            lines = []
+            for row in rows:
+                lines.append(json.dumps(visit_record(row)) + "\n")
+                if len(lines) >= EXPORT_BATCH_SIZE:
+                    yield "".join(lines)
+                    lines = []
+            yield "".join(lines)
+    finally:
+        db.close()
+
+
+@app.get("/devices/{device_id}/visits/export", dependencies=[Depends(auth.validate_token)])
+def export_device_visits(
+    device_id: str,
+    format: schemas.ExportFormat = schemas.ExportFormat.ndjson,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    db: Session = Depends(get_db),
+):
+    """Stream every visit to a device in [from, to) as NDJSON or CSV."""
+    start, end = to_naive_utc(start), to_naive_utc(end)
+    db_device = get_device_or_404(db, device_id)
+    media_type = "text/csv" if format == schemas.ExportFormat.csv else "application/x-ndjson"
+    filename = f"{device_id}-visits.{format.value}"
+    return StreamingResponse(
+        export_visits(db_device.id, start, end, format.value),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @app.get("/users/{username}", response_model=schemas.User, dependencies=[Depends(auth.validate_token)])
 def read_user_by_username(username: str, db: Session = Depends(get_db)):
     db_user = crud.get_user_by_username(db=db, username=username)
@@ -133,7 +500,7 @@ def read_user_by_username(username: str, db: Session = Depends(get_db)):
 
 @app.post("/token", response_model=auth.Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = auth.authenticate_user(db, form_data.username, form_data.password)
+    user = await auth.authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=401,
@@ -1,5 +1,5 @@
 """SQLAlchemy ORM classes modeling tables in the database."""
-from sqlalchemy import Column, Integer, Numeric, String
+from sqlalchemy import DDL, BigInteger, Column, Index, Integer, Numeric, SmallInteger, String, event, text
 from sqlalchemy.dialects.mssql import DATETIME2
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.schema import ForeignKey
@@ -41,6 +41,15 @@ class Bird(Base):
 class Visit(Base):
     """Discrete events from birds visiting."""
     __tablename__ = "visits"
+    __table_args__ = (
+        # Covers per-device, time-windowed queries without touching the base table
+        Index("ix_visits_device_id_visited_at", "device_id", "visited_at", mssql_include=["visiting_bird"]),
+        # Prevents a visit ingested from Event Hub from being stored twice
+        Index("ux_visits_partition_id_sequence_number", "partition_id", "sequence_number", "batch_index", unique=True, mssql_where=text("sequence_number IS NOT NULL")),
+        # SQL Server rejects OUTPUT without INTO on tables with triggers, such as the one
+        # keeping species_visit_counts up to date
+        {"implicit_returning": False},
+    )
 
     id = Column(Integer, primary_key=True)
     visiting_bird = Column(Integer, ForeignKey("bird_species.id"), nullable=False)
@@ -48,6 +57,65 @@ class Visit(Base):
     visited_at = Column(DATETIME2, nullable=False)
     latitude = Column(Numeric(precision=9, scale=6), nullable=False)
     longitude = Column(Numeric(precision=9, scale=6), nullable=False)
+    partition_id = Column(String(32)) # Event Hub partition and sequence number of the event the visit
+    sequence_number = Column(BigInteger) # was ingested from; NULL for visits stored by other means
+    batch_index = Column(SmallInteger, nullable=False, server_default=text("0")) # position within a batched event
 
     bird = relationship("Bird", back_populates="visits")
     device = relationship("Device", back_populates="visits")
+
+
+class SpeciesVisitCount(Base):
+    """Number of visits from each species to each device.
+
+    Kept up to date by a trigger on the visits table, so leaderboards can be read without
+    aggregating every visit.
+    """
+    __tablename__ = "species_visit_counts"
+
+    bird_id = Column(Integer, ForeignKey("bird_species.id"), primary_key=True)
+    device_id = Column(Integer, ForeignKey("devices.id"), primary_key=True)
+    num_visits = Column(Integer, nullable=False, default=0)
+
+    bird = relationship("Bird")
+
+
+# Keep species_visit_counts in sync with inserts, updates and deletes on visits
+SPECIES_VISIT_COUNTS_TRIGGER = DDL("""
+CREATE TRIGGER trg_visits_species_visit_counts ON visits AFTER INSERT, UPDATE, DELETE AS
+BEGIN
+    SET NOCOUNT ON;
+    MERGE species_visit_counts AS target
+    USING (
+        SELECT visiting_bird, device_id, SUM(delta) AS delta
+        FROM (
+            SELECT visiting_bird, device_id, 1 AS delta FROM inserted
+            UNION ALL
+            SELECT visiting_bird, device_id, -1 AS delta FROM deleted
+        ) AS changes
+        GROUP BY visiting_bird, device_id
+    ) AS source
+    ON target.bird_id = source.visiting_bird AND target.device_id = source.device_id
+    WHEN MATCHED THEN
+        UPDATE SET num_visits = target.num_visits + source.delta
+    WHEN NOT MATCHED THEN
+        INSERT (bird_id, device_id, num_visits) VALUES (source.visiting_bird, source.device_id, source.delta);
+END
+""")
+
+# Count visits that were stored before the counts table existed
+SPECIES_VISIT_COUNTS_BACKFILL = DDL("""
+INSERT INTO species_visit_counts (bird_id, device_id, num_visits)
+SELECT visiting_bird, device_id, COUNT(*) FROM visits GROUP BY visiting_bird, device_id
+""")
+
+
+@event.listens_for(Base.metadata, "after_create")
+def create_species_visit_counts_trigger(target, connection, tables=(), **kw):
+    """Install the trigger and backfill counts the first time species_visit_counts is created.
+
+    This runs after every table exists, since the trigger is defined on visits.
+    """
+    if SpeciesVisitCount.__table__ in tables:
+        connection.execute(SPECIES_VISIT_COUNTS_TRIGGER)
+        connection.execute(SPECIES_VISIT_COUNTS_BACKFILL)
@@ -0,0 +1,65 @@
+"""Non-blocking access to the IoT Hub registry."""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.iot.hub import IoTHubRegistryManager
+from azure.iot.hub.models import Twin
+
+# Number of registry calls that can be in flight at once. The registry manager's HTTP session
+# keeps up to 10 pooled connections per host, so more workers than that won't reuse connections.
+REGISTRY_WORKERS = int(os.getenv("REGISTRY_WORKERS", "10"))
+# Seconds to wait for a registry call before giving up
+REGISTRY_TIMEOUT = float(os.getenv("REGISTRY_TIMEOUT", "10"))
+
+# Characters twin property names can't contain (plus "%", the escape character itself)
+TWIN_NAME_ESCAPED = "%.$ "
+
+
+def twin_property_name(name: str) -> str:
+    """Return name percent-encoded so that it can be used as a twin property name.
+
+    Device IDs may contain ".", "$" and spaces, which twin property names reject. Only these
+    and "%" are encoded, so urllib.parse.unquote restores the original name.
+    """
+    return "".join("%{:02X}".format(ord(c)) if c in TWIN_NAME_ESCAPED else c for c in name)
+
+
+class AsyncRegistry:
+    """Runs the synchronous IoTHubRegistryManager on a dedicated, bounded thread pool.
+
+    Registry calls no longer occupy the threadpool Starlette uses for sync routes, and a
+    single registry manager is shared so its HTTP connections are reused between calls.
+
+    The HTTP client's own timeout matches the asyncio one and its retries are turned off, so
+    a call that times out also gives its worker thread back instead of blocking it until
+    IoT Hub answers.
+    """
+
+    def __init__(self, connection_string: str, max_workers: int = REGISTRY_WORKERS, timeout: float = REGISTRY_TIMEOUT) -> None:
+        self.registry_manager = IoTHubRegistryManager.from_connection_string(connection_string)
+        http_config = self.registry_manager.protocol.config
+        http_config.connection.timeout = timeout
+        http_config.retry_policy.retries = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="registry")
+        self.timeout = timeout
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(self.executor, func, *args), self.timeout)
+
+    async def get_twin(self, device_id: str) -> Twin:
+        """Return the twin of device_id. Raises asyncio.TimeoutError if the call takes too long."""
+        return await self._call(self.registry_manager.get_twin, device_id)
+
+    async def update_twin(self, device_id: str, twin_patch: Twin) -> Twin:
+        """Apply twin_patch to the twin of device_id and return the updated twin."""
+        return await self._call(self.registry_manager.update_twin, device_id, twin_patch)
+
+    async def update_module_twin(self, device_id: str, module_id: str, twin_patch: Twin) -> Twin:
+        """Apply twin_patch to the twin of a module on device_id and return the updated twin."""
+        return await self._call(self.registry_manager.update_module_twin, device_id, module_id, twin_patch)
+
+    def shutdown(self) -> None:
+        """Stop the worker threads."""
+        self.executor.shutdown(wait=False)
@@ -1,5 +1,7 @@
 """Pydantic models for parsing data from and returning data to API requests."""
-from typing import List
+from datetime import datetime
+from enum import Enum
+from typing import Dict, List, Optional
 from pydantic import BaseModel
 
 
@@ -21,4 +23,39 @@ class User(BaseModel):
         orm_mode = True
 
 class UnwelcomeVisitorList(BaseModel):
-    unwelcomeVisitors: List[str]
\ No newline at end of file
+    unwelcomeVisitors: List[str]
+
+class StatsBucket(str, Enum):
+    hour = "hour"
+    day = "day"
+
+
+class VisitStatsBucket(BaseModel):
+    start: datetime
+    counts: Dict[str, int]
+
+
+class VisitStats(BaseModel):
+    deviceId: str
+    bucket: StatsBucket
+    start: datetime
+    end: datetime
+    buckets: List[VisitStatsBucket]
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+class VisitRecord(BaseModel):
+    id: int
+    visiting_bird: str
+    visited_at: datetime
+    latitude: float
+    longitude: float
+
+
+class VisitPage(BaseModel):
+    visits: List[VisitRecord]
+    nextCursor: Optional[str] = None
@@ -0,0 +1,121 @@
+"""In-process cache of device twin reported properties."""
+import asyncio
+import copy
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict
+
+# Seconds a cached twin is served before it is fetched from the registry again
+TWIN_CACHE_TTL = float(os.getenv("TWIN_CACHE_TTL", "30"))
+# Maximum number of devices kept in the cache
+TWIN_CACHE_SIZE = int(os.getenv("TWIN_CACHE_SIZE", "1000"))
+
+
+def merge_patch(target: dict, patch: dict) -> dict:
+    """Apply a twin patch to target in place, removing keys whose patched value is None."""
+    for key, value in patch.items():
+        if key.startswith("$"):
+            # Skip metadata such as $version and $metadata
+            continue
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+class TwinCache:
+    """LRU cache of twin reported properties with a TTL and request coalescing.
+
+    Concurrent misses for the same device share a single registry call, which runs as its
+    own task so that it completes even if the request that started it is cancelled. Entries
+    are kept fresh by twin change events from the Event Hub consumer, so the TTL only bounds
+    how stale the cache can get if an event is missed.
+    """
+
+    def __init__(self, loader: Callable[[str], Awaitable[dict]], ttl: float = TWIN_CACHE_TTL, max_size: int = TWIN_CACHE_SIZE) -> None:
+        """Initialize an empty cache.
+
+        Args:
+            loader (Callable): coroutine function returning the reported properties of a device
+            ttl (float): seconds an entry is served before it is reloaded
+            max_size (int): maximum number of devices cached before the least recently used is evicted
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict() # device ID -> (expiry time, reported properties)
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    async def get_reported(self, device_id: str) -> dict:
+        """Return the reported properties for device_id, loading them if necessary."""
+        entry = self.entries.get(device_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            self.entries.move_to_end(device_id)
+            return entry[1]
+
+        self.misses += 1
+        pending = self.pending.get(device_id)
+        if pending is not None:
+            # Another request is already loading this twin
+            self.coalesced += 1
+        else:
+            pending = asyncio.ensure_future(self._load(device_id))
+            pending.add_done_callback(lambda task: self._loaded(device_id, task))
+            self.pending[device_id] = pending
+        # Shielded so that a cancelled request, e.g. after a client disconnects, doesn't cancel
+        # the load for the other requests waiting on it
+        return await asyncio.shield(pending)
+
+    async def _load(self, device_id: str) -> dict:
+        reported = await self.loader(device_id)
+        self._store(device_id, reported)
+        return reported
+
+    def _loaded(self, device_id: str, task: asyncio.Future) -> None:
+        if self.pending.get(device_id) is task:
+            del self.pending[device_id]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every waiting request was cancelled
+            task.exception()
+
+    def apply_patch(self, device_id: str, patch: dict) -> None:
+        """Update a cached entry with a reported properties patch from a twin change event.
+
+        Devices that are not cached are left alone, since the patch may only hold the
+        properties that changed.
+        """
+        entry = self.entries.get(device_id)
+        if entry is None:
+            return
+        self._store(device_id, merge_patch(copy.deepcopy(entry[1]), patch))
+
+    def invalidate(self, device_id: str) -> None:
+        """Remove device_id from the cache so the next read reloads it."""
+        self.entries.pop(device_id, None)
+
+    def stats(self) -> dict:
+        """Return cache size and hit, miss, coalesced miss and eviction counts."""
+        return {
+            "size": len(self.entries),
+            "maxSize": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+    def _store(self, device_id: str, reported: dict) -> None:
+        self.entries[device_id] = (time.monotonic() + self.ttl, reported)
+        self.entries.move_to_end(device_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
@@ -403,6 +403,7 @@ meta_copy_func (gpointer data, gpointer user_data)
       
       if (srcObj->species)
         obj->species = g_strdup (srcObj->species);
+      obj->confidence = srcObj->confidence;
 
       dstMeta->extMsg = obj;
       dstMeta->extMsgSize = sizeof (NvDsBirdObject);
@@ -624,6 +625,7 @@ generate_event_msg_meta (gpointer data, gint class_id, gboolean useTs,
         } else if (label->result_label[0] != '\0') {
           obj->species = g_strdup (label->result_label);
         }
+        obj->confidence = label->result_prob;
       }
     }
 
@@ -179,6 +179,7 @@ typedef struct NvDsFaceObject {
  */
 typedef struct NvDsBirdObject {
   gchar *species;   /**< Holds a pointer to the bird's species. */
+  gdouble confidence; /**< Holds the species classifier's confidence. */
 } NvDsBirdObject;
 
 /**
@@ -565,9 +565,11 @@ generate_object_object (NvDsMsg2pCtx *ctx, NvDsEventMsgMeta *meta)
         NvDsBirdObject *dsObj = (NvDsBirdObject *) meta->extMsg;
         if (dsObj) {
           json_object_set_string_member (jobject, "species", dsObj->species);
+          json_object_set_double_member (jobject, "confidence", dsObj->confidence);
         }
       } else {
         json_object_set_string_member (jobject, "species", "");
+        json_object_set_double_member (jobject, "confidence", 0.0);
       }
       json_object_set_object_member (objectObj, "bird", jobject);
       break;
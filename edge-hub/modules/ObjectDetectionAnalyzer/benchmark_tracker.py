@@ -0,0 +1,124 @@
+"""Micro-benchmark of the per-message tracking overhead and memory per tracked object.
+
+Compares the current ObjectTracker, which stores slotted TrackingInfo objects with
+monotonic nanosecond timestamps, against the previous representation: a dataclass holding
+datetime.datetime values, with datetime.now() and timedelta arithmetic on every message.
+
+Usage:
+    python3 benchmark_tracker.py [--messages N] [--objects N]
+"""
+import argparse
+import datetime
+import time
+import tracemalloc
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+from object_tracker import ObjectTracker
+
+
+@dataclass
+class LegacyTrackingInfo:
+    """Tracking info as it was stored before monotonic timestamps."""
+    arrival_time: Any
+    message_sent: bool
+    last_seen: Any = None
+
+
+class LegacyTracker:
+    """ObjectTracker using datetime-based LegacyTrackingInfo entries."""
+
+    def __init__(self, capacity: int, ttl: float) -> None:
+        self.capacity = capacity
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.cache = OrderedDict()
+
+    def update_last_seen(self, id):
+        tracking_info = self.cache.get(id)
+        if tracking_info is None:
+            return None
+        tracking_info.last_seen = datetime.datetime.now()
+        self.cache.move_to_end(id)
+        return tracking_info
+
+    def start_tracking(self, id):
+        now = datetime.datetime.now()
+        while self.cache:
+            oldest_info = next(iter(self.cache.values()))
+            if now - oldest_info.last_seen < self.ttl:
+                break
+            self.cache.popitem(last=False)
+        self.cache[id] = LegacyTrackingInfo(arrival_time=now, message_sent=False, last_seen=now)
+        if len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+
+def legacy_handle(tracker, tracking_id, threshold):
+    tracking_info = tracker.update_last_seen(tracking_id)
+    if tracking_info is not None:
+        tracking_duration = datetime.datetime.now() - tracking_info.arrival_time
+        if tracking_duration >= threshold and not tracking_info.message_sent:
+            tracking_info.message_sent = True
+    else:
+        tracker.start_tracking(tracking_id)
+
+
+def current_handle(tracker, tracking_id, threshold):
+    now = time.monotonic_ns()
+    tracking_info = tracker.update_last_seen(tracking_id, now)
+    if tracking_info is not None:
+        tracking_duration = now - tracking_info.arrival_time
+        if tracking_duration >= threshold and not tracking_info.message_sent:
+            tracking_info.message_sent = True
+    else:
+        tracker.start_tracking(tracking_id, now)
+
+
+def time_messages(handle, tracker, threshold, num_messages, num_objects):
+    """Return the mean handling time per message in nanoseconds."""
+    ids = [str(i % num_objects) for i in range(num_messages)]
+    start = time.perf_counter_ns()
+    for tracking_id in ids:
+        handle(tracker, tracking_id, threshold)
+    return (time.perf_counter_ns() - start) / num_messages
+
+
+def bytes_per_object(tracker, handle, threshold, num_objects):
+    """Return the memory allocated per tracked object when num_objects are tracked."""
+    ids = [str(i) for i in range(num_objects)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for tracking_id in ids:
+        handle(tracker, tracking_id, threshold)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return allocated / num_objects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500000, help="number of detection messages to simulate")
+    parser.add_argument("--objects", type=int, default=5000, help="number of concurrently tracked objects")
+    args = parser.parse_args()
+
+    capacity = args.objects * 2
+    ttl = 60.0
+    results = {}
+    for name, make_tracker, handle, threshold in (
+        ("before (dataclass, datetime)", lambda: LegacyTracker(capacity, ttl), legacy_handle, datetime.timedelta(seconds=1.0)),
+        ("after (slots, monotonic ns)", lambda: ObjectTracker(capacity, ttl), current_handle, int(1.0 * 1e9)),
+    ):
+        per_message = time_messages(handle, make_tracker(), threshold, args.messages, args.objects)
+        per_object = bytes_per_object(make_tracker(), handle, threshold, args.objects)
+        results[name] = (per_message, per_object)
+
+    print(f"{args.messages} messages, {args.objects} tracked objects")
+    print(f"{'representation':<32}{'ns/message':>12}{'bytes/object':>14}")
+    for name, (per_message, per_object) in results.items():
+        print(f"{name:<32}{per_message:>12.0f}{per_object:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,31 +3,104 @@
 # full license information.
 
 import asyncio
+import os
 import sys
 import signal
 import threading
 import json
-import datetime
+import time
 from azure.iot.device.aio import IoTHubModuleClient
-from object_tracker import ObjectTracker, TrackingInfo
+from object_tracker import monotonic_to_datetime
+from message_decoder import get_decoder, peek_sensor_id, peek_species_vote, peek_tracking_id, species_vote
+from species_votes import SpeciesVotes
+from stream_trackers import StreamTrackers
+from work_queue import WorkQueue
+from visitor_alerts import VisitorAlertFilter
+from visit_batcher import VisitBatcher
+from metrics import MetricsRegistry
 
 
 # Event indicating client stop
 stop_event = threading.Event()
 
-# Tracker to help determine which objects have been previously seen
-object_tracker = ObjectTracker()
+# Trackers to help determine which objects have been previously seen, one per camera
+stream_trackers = StreamTrackers(
+    capacity=int(os.getenv("TRACKER_CAPACITY", "1000")),
+    ttl=float(os.getenv("TRACKER_TTL_SECONDS", "5.0")),
+    max_streams=int(os.getenv("MAX_STREAMS", "16"))
+)
 
-# Minimum time that an object should be observed for before sending a visit message
-tracking_duration_threshold = datetime.timedelta(seconds=1.0)
+# Queue of outgoing messages and method calls, so sending never holds up receiving
+output_queue = WorkQueue(
+    maxsize=int(os.getenv("OUTPUT_QUEUE_SIZE", "100")),
+    num_workers=int(os.getenv("OUTPUT_SENDERS", "4"))
+)
 
+# Filters and coalesces checkIfVisitorUnwelcome calls to the feeders
+visitor_alert_filter = VisitorAlertFilter(cooldown=float(os.getenv("VISITOR_ALERT_COOLDOWN_SECONDS", "30")))
 
-def construct_bird_visit_message(message_dict, timestamp):
+# Number of visits packed into each bird_visits message (1 sends each visit on its own)
+VISIT_BATCH_SIZE = int(os.getenv("VISIT_BATCH_SIZE", "1"))
+# Maximum seconds a visit waits for its batch to be sent
+VISIT_BATCH_SECONDS = float(os.getenv("VISIT_BATCH_SECONDS", "10"))
+# Compress batched visits with gzip. Only the backend's visit ingestion can read these; the
+# Stream Analytics job's input expects uncompressed messages
+VISIT_BATCH_GZIP = os.getenv("VISIT_BATCH_GZIP", "false").lower() == "true"
+
+# Seconds to keep sending batched and queued outputs after the module is told to stop
+SHUTDOWN_FLUSH_SECONDS = float(os.getenv("SHUTDOWN_FLUSH_SECONDS", "5"))
+
+# Seconds between printouts of the output queue's statistics
+STATS_INTERVAL = float(os.getenv("STATS_INTERVAL_SECONDS", "60"))
+
+# Port serving Prometheus metrics at /metrics (0 disables the endpoint)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Seconds between reports of the metrics as reported properties of the module twin (0 disables them)
+METRICS_TWIN_SECONDS = float(os.getenv("METRICS_TWIN_SECONDS", "0"))
+
+# Metrics are only recorded if something reads them
+metrics = MetricsRegistry(enabled=METRICS_PORT > 0 or METRICS_TWIN_SECONDS > 0)
+handler_seconds = metrics.histogram(
+    "analyzer_handler_seconds", "Time spent handling a detection message",
+    [0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01]
+)
+parse_seconds = metrics.histogram(
+    "analyzer_parse_seconds", "Time spent fully decoding a detection message",
+    [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025]
+)
+method_call_seconds = metrics.histogram(
+    "analyzer_method_call_seconds", "Duration of checkIfVisitorUnwelcome calls to the feeders",
+    [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+)
+method_call_failures = metrics.counter(
+    "analyzer_method_call_failures_total", "checkIfVisitorUnwelcome calls that raised or returned an error status"
+)
+
+# JSON decoder for detection messages
+decoder_name, decode_message = get_decoder()
+decode_message = metrics.timed(decode_message, parse_seconds)
+
+# Minimum time that an object should be observed for before sending a visit message, in nanoseconds
+tracking_duration_threshold = int(1.0 * 1e9)
+
+# Number of species classifications of a bird needed before its visit is sent
+MIN_SPECIES_VOTES = int(os.getenv("MIN_SPECIES_VOTES", "3"))
+# Maximum number of species whose votes are kept at once for each bird
+MAX_SPECIES_CANDIDATES = int(os.getenv("MAX_SPECIES_CANDIDATES", "4"))
+# Time after which a bird's visit is sent with however many votes it has, in nanoseconds
+species_vote_timeout = int(float(os.getenv("SPECIES_VOTE_TIMEOUT_SECONDS", "3.0")) * 1e9)
+
+# Source of time.monotonic_ns() timestamps for detections; replaced by a simulated clock when replaying
+clock = time.monotonic_ns
+
+
+def construct_bird_visit(message_dict, timestamp, species=None, confidence=None):
     sensor = message_dict["sensor"]
     device_id = sensor["id"]
     latitude = sensor["location"]["lat"]
     longitude = sensor["location"]["lon"]
-    species = message_dict["object"]["bird"]["species"]
+    if species is None:
+        species = message_dict["object"]["bird"]["species"]
     visit_message_dict = {
         "visiting_bird": species,
         "device_id": device_id,
@@ -35,104 +108,278 @@ def construct_bird_visit_message(message_dict, timestamp):
         "latitude": latitude,
         "longitude": longitude
     }
-    return json.dumps(visit_message_dict)
+    if confidence is not None:
+        visit_message_dict["confidence"] = round(confidence, 3)
+    return visit_message_dict
 
 
-def create_client():
-    client = IoTHubModuleClient.create_from_edge_environment()
+def construct_bird_visit_message(message_dict, timestamp, species=None, confidence=None):
+    return json.dumps(construct_bird_visit(message_dict, timestamp, species, confidence))
+
+
+def collect_metrics():
+    """Return samples of the statistics kept by the trackers, output queue and visitor alert filter."""
+    for sensor_id, stream in list(stream_trackers.streams.items()):
+        labels = {"sensor": sensor_id}
+        yield "analyzer_messages_total", "counter", "Detection messages received", labels, stream.messages
+        yield "analyzer_visits_total", "counter", "Bird visits emitted", labels, stream.visits
+        yield "analyzer_alerts_total", "counter", "checkIfVisitorUnwelcome calls made", labels, stream.alerts
+        yield "analyzer_tracked_objects", "gauge", "Tracking IDs currently tracked", labels, len(stream.tracker.cache)
+        yield "analyzer_tracker_evictions_total", "counter", "Tracking IDs forgotten because the tracker was full", labels, stream.tracker.evictions
+        yield "analyzer_tracker_expirations_total", "counter", "Tracking IDs forgotten because they were no longer seen", labels, stream.tracker.expirations
+    yield "analyzer_rejected_messages_total", "counter", "Messages ignored because MAX_STREAMS cameras were already tracked", {}, stream_trackers.rejected
+    queue_stats = output_queue.stats()
+    yield "analyzer_output_queue_depth", "gauge", "Outgoing messages and method calls waiting to be sent", {}, queue_stats["depth"]
+    for result in ("completed", "failed", "dropped"):
+        yield "analyzer_output_jobs_total", "counter", "Outgoing messages and method calls by result", {"result": result}, queue_stats[result]
+    for result, count in visitor_alert_filter.stats().items():
+        yield "analyzer_visitor_alerts_total", "counter", "Non-bird visitors by whether the feeder was alerted", {"result": result}, count
+
+
+def create_message_handler(client):
+    """Return the coroutine function that handles messages received by client.
+
+    client only needs send_message_to_output and invoke_method coroutines, so a stand-in
+    can be used to replay recorded messages (see replay.py).
+    """
+    # Optionally pack several visits into each bird_visits message
+    visit_batcher = None
+    if VISIT_BATCH_SIZE > 1:
+        visit_batcher = VisitBatcher(
+            submit=lambda message: output_queue.submit(lambda: client.send_message_to_output(message, "bird_visits")),
+            max_visits=VISIT_BATCH_SIZE,
+            max_delay=VISIT_BATCH_SECONDS,
+            compress=VISIT_BATCH_GZIP
+        )
 
     # Define function for handling received messages
     async def receive_message_handler(message):
         # NOTE: This function only handles messages sent to "input1".
         # Messages sent to other inputs, or to the default, will be discarded
         if message.input_name == "detection_messages":
-            # Parse message as JSON
-            message_dict = json.loads(message.data)
+            # Read the sensor and tracking IDs without parsing the whole message, if possible.
+            # Most messages are for objects that are already tracked and need nothing else.
+            message_dict = None
+            sensor_id = peek_sensor_id(message.data)
+            tracking_id = peek_tracking_id(message.data)
+            if sensor_id is None or tracking_id is None:
+                # Parse message as JSON
+                message_dict = decode_message(message.data)
 
-            # Get object detection data
-            if not "object" in message_dict:
-                print("Object detection data not found in message routed to detection_messages input")
-                return
-            object = message_dict["object"]
+                # Get object detection data
+                if not "object" in message_dict:
+                    print("Object detection data not found in message routed to detection_messages input")
+                    return
+                object = message_dict["object"]
+
+                # Get tracking ID
+                if not "id" in object:
+                    print("Tracking ID not found in object detection data")
+                    return
+                tracking_id = object["id"]
+
+                # Get sensor ID, since tracking IDs are only unique per camera
+                if not "id" in message_dict.get("sensor", {}):
+                    print("Sensor ID not found in message routed to detection_messages input")
+                    return
+                sensor_id = message_dict["sensor"]["id"]
 
-            # Get tracking ID
-            if not "id" in object:
-                print("Tracking ID not found in object detection data")
+            stream = stream_trackers.get(sensor_id)
+            if stream is None:
                 return
-            tracking_id = object["id"]
+            stream.messages += 1
 
             # Print summary
-            # Send message if the tracking duration exceeds the threshold
-            global object_tracker
             global tracking_duration_threshold
-            if object_tracker.contains(tracking_id):
-                tracking_info = object_tracker.get_tracking_info(tracking_id)
-                tracking_duration = datetime.datetime.now() - tracking_info.arrival_time
-                if tracking_duration >= tracking_duration_threshold and not tracking_info.message_sent:
-                    # Set message_sent to True to prevent duplicate messages
-                    tracking_info.message_sent = True
-
-                    if "bird" in object:
-                        # Send message indicating a visit from a bird
-                        output_message = construct_bird_visit_message(message_dict, tracking_info.arrival_time.isoformat())
-                        await client.send_message_to_output(output_message, "bird_visits")
-                    else:
-                        # Non-bird visitor - alert the feeder in case they're unwelcome
-                        device_id = message_dict["sensor"]["id"]
-                        method_params = {
-                            "methodName": "checkIfVisitorUnwelcome",
-                            "responseTimeoutInSeconds": 30,
-                            "connectTimeoutInSeconds": 20,
-                            "payload": object
-                        }
-                        await client.invoke_method(method_params, device_id)
+            now = clock()
+            tracking_info = stream.tracker.update_last_seen(tracking_id, now)
+            if tracking_info is None:
+                stream.tracker.start_tracking(tracking_id, now)
+                tracking_info = stream.tracker.get_tracking_info(tracking_id)
+            if tracking_info.message_sent:
+                return
+
+            # Count the classifier's vote for the bird's species in this frame
+            if message_dict is None:
+                vote = peek_species_vote(message.data)
+                if vote is None:
+                    message_dict = decode_message(message.data)
+            if message_dict is not None:
+                vote = species_vote(message_dict["object"])
+            species, confidence = vote
+            if species:
+                if tracking_info.votes is None:
+                    tracking_info.votes = SpeciesVotes(max_candidates=MAX_SPECIES_CANDIDATES)
+                tracking_info.votes.add(species, confidence)
+
+            # Send message if the tracking duration exceeds the threshold
+            tracking_duration = now - tracking_info.arrival_time
+            if tracking_duration < tracking_duration_threshold:
+                return
+            votes = tracking_info.votes
+            if species is not None and tracking_duration < species_vote_timeout:
+                if votes is None or votes.votes < MIN_SPECIES_VOTES:
+                    # Wait for more classifications before deciding on the species
+                    return
+
+            # Set message_sent to True to prevent duplicate messages
+            tracking_info.message_sent = True
+            tracking_info.votes = None
+
+            # Only now is the rest of the message needed
+            if message_dict is None:
+                message_dict = decode_message(message.data)
+            object = message_dict["object"]
+
+            if "bird" in object:
+                # Send message indicating a visit from a bird, with the species most voted for
+                species, confidence = (None, 0.0) if votes is None else votes.decide()
+                arrival_time = monotonic_to_datetime(tracking_info.arrival_time)
+                stream.visits += 1
+                if visit_batcher is not None:
+                    visit_batcher.add(construct_bird_visit(message_dict, arrival_time.isoformat(), species, confidence))
+                else:
+                    output_message = construct_bird_visit_message(message_dict, arrival_time.isoformat(), species, confidence)
+                    output_queue.submit(lambda: client.send_message_to_output(output_message, "bird_visits"))
             else:
-                object_tracker.start_tracking(tracking_id)
+                # Non-bird visitor - alert the feeder in case they're unwelcome
+                device_id = sensor_id
+                if not visitor_alert_filter.should_alert(device_id, object, now):
+                    return
+                stream.alerts += 1
+                method_params = {
+                    "methodName": "checkIfVisitorUnwelcome",
+                    "responseTimeoutInSeconds": 30,
+                    "connectTimeoutInSeconds": 20,
+                    "payload": object
+                }
+                output_queue.submit(lambda: invoke_method(client, method_params, device_id))
+
+    handler = receive_message_handler
+    if metrics.enabled:
+        async def handler(message):
+            start = time.perf_counter_ns()
+            await receive_message_handler(message)
+            handler_seconds.observe((time.perf_counter_ns() - start) / 1e9)
+
+    # Exposed so that pending visits can be flushed when replaying
+    handler.visit_batcher = visit_batcher
+    return handler
+
+
+async def invoke_method(client, method_params, device_id):
+    """Invoke a direct method on a feeder, recording the call's duration and failures."""
+    start = time.perf_counter()
+    try:
+        response = await client.invoke_method(method_params, device_id)
+    except Exception:
+        method_call_failures.inc()
+        raise
+    finally:
+        method_call_seconds.observe(time.perf_counter() - start)
+    if isinstance(response, dict) and response.get("status", 200) >= 400:
+        method_call_failures.inc()
+    return response
+
+
+def create_client():
+    client = IoTHubModuleClient.create_from_edge_environment()
+
+    # Define function for handling received messages
+    receive_message_handler = create_message_handler(client)
+
+    # Define function for handling module twin patches
+    def twin_patch_handler(patch):
+        if "unwelcomeVisitors" in patch:
+            print(f"Updating unwelcome visitors to {patch['unwelcomeVisitors']}")
+            visitor_alert_filter.update_from_twin(patch)
 
     try:
-        # Set handler on the client
+        # Set handlers on the client
         client.on_message_received = receive_message_handler
+        client.on_twin_desired_properties_patch_received = twin_patch_handler
     except:
         # Cleanup if failure occurs
         client.shutdown()
         raise
 
-    return client
+    return client, receive_message_handler
 
 
 async def busy_wait(client):
     # Customize this coroutine to do whatever tasks the module initiates
     # e.g. sending messages
     while True:
-        await asyncio.sleep(1000)
+        await asyncio.sleep(STATS_INTERVAL)
+        print(f"Output queue: {output_queue.stats()}")
+        print(f"Visitor alerts: {visitor_alert_filter.stats()}")
+        print(f"Streams: {stream_trackers.stats()}")
+
+
+async def flush_outputs(handler, timeout=None):
+    """Send the visits still batched and wait up to timeout seconds for queued outputs to be sent."""
+    if handler.visit_batcher is not None:
+        handler.visit_batcher.close()
+    if not await output_queue.drain(timeout):
+        print(f"Discarding outputs not sent within {timeout} seconds: {output_queue.stats()}")
+
+
+async def report_metrics(client):
+    # Periodically copy the metrics to the module twin
+    while True:
+        await asyncio.sleep(METRICS_TWIN_SECONDS)
+        try:
+            await client.patch_twin_reported_properties({"metrics": metrics.snapshot()})
+        except Exception as e:
+            print(f"Failed to report metrics: {e}")
 
 
 def main():
     if not sys.version >= "3.5.3":
         raise Exception( "The module requires python 3.5.3+. Current version of Python: %s" % sys.version )
     print ( "Object Detection Analyzer" )
+    print(f"Using {decoder_name} to decode detection messages")
+    if VISIT_BATCH_GZIP and VISIT_BATCH_SIZE > 1:
+        print("Warning: gzipped visit batches can't be read by the Stream Analytics job, so visits are only stored if the backend ingests them (INGEST_VISITS=true)")
 
     # NOTE: Client is implicitly connected due to the handler being set on it
-    client = create_client()
+    client, handler = create_client()
     print("Finished creating client.")
 
+    loop = asyncio.get_event_loop()
+    busy_task = loop.create_task(busy_wait(client))
+
     # Define a handler to cleanup when module is is terminated by Edge
     def module_termination_handler(signal, frame):
         print ("Object Detection Analyzer module stopped by Edge")
         stop_event.set()
+        loop.call_soon_threadsafe(busy_task.cancel)
 
     # Set the Edge termination handler
     signal.signal(signal.SIGTERM, module_termination_handler)
 
     # Run the sample
-    loop = asyncio.get_event_loop()
     try:
-        loop.run_until_complete(busy_wait(client))
+        # Load each feeder's unwelcome visitors from the module twin
+        twin = loop.run_until_complete(client.get_twin())
+        visitor_alert_filter.update_from_twin(twin["desired"])
+        metrics.add_collector(collect_metrics)
+        if METRICS_PORT > 0:
+            metrics.serve(METRICS_PORT)
+            print(f"Serving metrics on port {METRICS_PORT}")
+        if METRICS_TWIN_SECONDS > 0:
+            loop.create_task(report_metrics(client))
+        loop.run_until_complete(busy_task)
+    except asyncio.CancelledError:
+        pass
     except Exception as e:
         print("Unexpected error %s " % e)
         raise
     finally:
         print("Shutting down Object Detection Analyzer...")
+        busy_task.cancel()
+        # Don't lose the visits still waiting for their batch or in the output queue
+        loop.run_until_complete(flush_outputs(handler, SHUTDOWN_FLUSH_SECONDS))
         loop.run_until_complete(client.shutdown())
         loop.close()
 
@@ -0,0 +1,116 @@
+"""JSON decoding of DeepStream detection messages.
+
+The fastest available decoder is used: orjson, then msgspec, then the standard library.
+Set the JSON_DECODER environment variable to "orjson", "msgspec" or "json" to pick one.
+"""
+import json
+import os
+import re
+from typing import Callable, Optional, Tuple, Union
+
+# Matches the tracking ID, which nvmsgconv writes as the first member of the "object" object
+_TRACKING_ID_PATTERN = re.compile(rb'"object"\s*:\s*\{\s*"id"\s*:\s*"([^"\\]*)"')
+# Matches the sensor ID, which nvmsgconv writes as the first member of the "sensor" object
+_SENSOR_ID_PATTERN = re.compile(rb'"sensor"\s*:\s*\{\s*"id"\s*:\s*"([^"\\]*)"')
+# Matches the species, and the classifier's confidence if present, of a "bird" object
+_SPECIES_PATTERN = re.compile(rb'"bird"\s*:\s*\{\s*"species"\s*:\s*"([^"\\]*)"(?:\s*,\s*"confidence"\s*:\s*([-+.0-9eE]+))?')
+
+
+def _orjson_decoder() -> Callable:
+    import orjson
+    return orjson.loads
+
+
+def _msgspec_decoder() -> Callable:
+    import msgspec
+    return msgspec.json.Decoder().decode
+
+
+def _json_decoder() -> Callable:
+    return json.loads
+
+
+DECODERS = {
+    "orjson": _orjson_decoder,
+    "msgspec": _msgspec_decoder,
+    "json": _json_decoder,
+}
+
+
+def get_decoder(name: Optional[str] = None) -> Tuple[str, Callable]:
+    """Return the name and decode function of a JSON decoder.
+
+    Args:
+        name (str): "orjson", "msgspec", "json" or "auto". "auto" (the default) picks the
+            first decoder that is installed.
+
+    Returns:
+        tuple: the name of the decoder that was picked and a function decoding bytes or str
+    """
+    if name is None:
+        name = os.getenv("JSON_DECODER", "auto")
+    if name != "auto":
+        return name, DECODERS[name]()
+    for candidate, make_decoder in DECODERS.items():
+        try:
+            return candidate, make_decoder()
+        except ImportError:
+            continue
+    return "json", json.loads
+
+
+def _peek(pattern, data: Union[bytes, str]) -> Optional[str]:
+    if isinstance(data, str):
+        data = data.encode()
+    match = pattern.search(data)
+    if match is None:
+        return None
+    return match.group(1).decode()
+
+
+def peek_tracking_id(data: Union[bytes, str]) -> Optional[str]:
+    """Return the object's tracking ID without decoding the whole message.
+
+    Returns:
+        str: the tracking ID, or None if it couldn't be found, in which case the message
+            should be fully decoded instead
+    """
+    return _peek(_TRACKING_ID_PATTERN, data)
+
+
+def peek_sensor_id(data: Union[bytes, str]) -> Optional[str]:
+    """Return the sensor ID of the camera that sent the message without decoding the whole message.
+
+    Returns:
+        str: the sensor ID, or None if it couldn't be found, in which case the message
+            should be fully decoded instead
+    """
+    return _peek(_SENSOR_ID_PATTERN, data)
+
+
+def peek_species_vote(data: Union[bytes, str]) -> Optional[Tuple[Optional[str], float]]:
+    """Return the bird species the classifier reported and its confidence without decoding the whole message.
+
+    Returns:
+        tuple: the species and confidence. The species is None if the object isn't a bird and
+            "" if it wasn't classified in this frame. The confidence is 1.0 if the message
+            doesn't include one. None is returned instead of a tuple if the species couldn't be
+            found, in which case the message should be fully decoded instead.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    if b'"bird"' not in data:
+        return None, 0.0
+    match = _SPECIES_PATTERN.search(data)
+    if match is None:
+        return None
+    species, confidence = match.groups()
+    return species.decode(), 1.0 if confidence is None else float(confidence)
+
+
+def species_vote(object: dict) -> Tuple[Optional[str], float]:
+    """Return the bird species and confidence of a decoded object, like peek_species_vote()."""
+    bird = object.get("bird")
+    if bird is None:
+        return None, 0.0
+    return bird.get("species") or "", float(bird.get("confidence", 1.0))
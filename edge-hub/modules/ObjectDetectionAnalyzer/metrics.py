@@ -0,0 +1,192 @@
+"""Counters and histograms exposed in the Prometheus text format.
+
+Metrics that are already counted elsewhere (e.g. by the trackers or the output queue) are
+read by collector functions when the metrics are rendered, so they cost nothing per message.
+Only timings need to be recorded on the hot path. When the registry is disabled, it hands
+out metrics whose methods do nothing, and callers can check `enabled` to skip taking timings
+altogether.
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# (name, type, help, labels, value) of one sample reported by a collector
+Sample = Tuple[str, str, str, Dict[str, str], float]
+
+
+class Counter:
+    """Monotonically increasing count."""
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Histogram:
+    """Counts of observations in cumulative buckets, like a Prometheus histogram."""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Iterable[float]) -> None:
+        self.bounds = sorted(bounds)
+        self.counts = [0] * len(self.bounds) # non-cumulative; the last bucket (+Inf) is count
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _NullMetric:
+    """Stand-in for a counter or histogram when metrics are disabled."""
+    __slots__ = ()
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+
+_NULL_METRIC = _NullMetric()
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _twin_key(labels: Dict[str, str]) -> str:
+    # Twin property names can't contain ".", "$" or spaces
+    key = ",".join(str(value) for value in labels.values())
+    return key.replace(".", "_").replace("$", "_").replace(" ", "_")
+
+
+class MetricsRegistry:
+    """Named counters, histograms and collector functions."""
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.metrics = {} # name -> (type, help, metric)
+        self.collectors: List[Callable[[], Iterable[Sample]]] = []
+        self.server = None
+
+    def counter(self, name: str, help: str) -> Counter:
+        """Return a new counter, or a no-op stand-in if metrics are disabled."""
+        if not self.enabled:
+            return _NULL_METRIC
+        counter = Counter()
+        self.metrics[name] = ("counter", help, counter)
+        return counter
+
+    def histogram(self, name: str, help: str, bounds: Iterable[float]) -> Histogram:
+        """Return a new histogram with the given bucket upper bounds, or a no-op stand-in if metrics are disabled."""
+        if not self.enabled:
+            return _NULL_METRIC
+        histogram = Histogram(bounds)
+        self.metrics[name] = ("histogram", help, histogram)
+        return histogram
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        """Register a function returning samples to report each time the metrics are rendered."""
+        if self.enabled:
+            self.collectors.append(collector)
+
+    def timed(self, function: Callable, histogram: Histogram) -> Callable:
+        """Return function wrapped to observe its duration in seconds, or function itself if metrics are disabled."""
+        if not self.enabled:
+            return function
+
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe((time.perf_counter_ns() - start) / 1e9)
+        return timed_function
+
+    def _samples(self) -> Iterable[Sample]:
+        for collector in self.collectors:
+            try:
+                yield from collector()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, (type, help, metric) in self.metrics.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            if type == "histogram":
+                cumulative = 0
+                for bound, count in zip(metric.bounds, metric.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {metric.count}')
+                lines.append(f"{name}_sum {metric.sum}")
+                lines.append(f"{name}_count {metric.count}")
+            else:
+                lines.append(f"{name} {metric.value}")
+
+        described = set()
+        for name, type, help, labels, value in sorted(self._samples(), key=lambda sample: sample[0]):
+            if name not in described:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type}")
+                described.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Return current values as a dict suitable for reported twin properties.
+
+        Histograms are reported as their count and sum, and labelled samples are nested by
+        their label values.
+        """
+        snapshot = {}
+        for name, (type, help, metric) in self.metrics.items():
+            if type == "histogram":
+                snapshot[name] = {"count": metric.count, "sum": metric.sum}
+            else:
+                snapshot[name] = metric.value
+        for name, type, help, labels, value in self._samples():
+            if labels:
+                snapshot.setdefault(name, {})[_twin_key(labels)] = value
+            else:
+                snapshot[name] = value
+        return snapshot
+
+    def serve(self, port: int) -> None:
+        """Serve the metrics at http://<host>:<port>/metrics from a background thread."""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Don't print every scrape
+                pass
+
+        self.server = ThreadingHTTPServer(("", port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
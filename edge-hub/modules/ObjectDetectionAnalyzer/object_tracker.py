@@ -1,23 +1,54 @@
-from dataclasses import dataclass
-from typing import Any
+from collections import OrderedDict
 import datetime
+import time
+
+
+def monotonic_to_datetime(monotonic_ns: int) -> datetime.datetime:
+    """Convert a time.monotonic_ns() timestamp to the local wall-clock time it corresponds to."""
+    wall_ns = time.time_ns() - (time.monotonic_ns() - monotonic_ns)
+    return datetime.datetime.fromtimestamp(wall_ns / 1e9)
+
 
-@dataclass
 class TrackingInfo:
-    """Necessary information associated with a tracking ID."""
-    arrival_time: Any
-    message_sent: bool
+    """Necessary information associated with a tracking ID.
+
+    Times are time.monotonic_ns() timestamps, which are cheaper to take and compare than
+    datetimes. Use monotonic_to_datetime() to convert them when a message is sent.
+
+    votes holds the species votes of a bird until its visit is sent, and is None otherwise.
+    """
+    __slots__ = ("arrival_time", "message_sent", "last_seen", "votes")
+
+    def __init__(self, arrival_time: int, message_sent: bool, last_seen: int = None) -> None:
+        self.arrival_time = arrival_time
+        self.message_sent = message_sent
+        self.last_seen = arrival_time if last_seen is None else last_seen
+        self.votes = None
+
+    def __repr__(self) -> str:
+        return f"TrackingInfo(arrival_time={self.arrival_time}, message_sent={self.message_sent}, last_seen={self.last_seen})"
 
 class ObjectTracker:
-    def __init__(self, capacity: int = 10) -> None:
-        """Set the ObjectTracker's capacity to the argument and initialize its cache to be empty."""
+    def __init__(self, capacity: int = 1000, ttl: float = 5.0) -> None:
+        """Initialize an empty tracker.
+
+        Entries are kept in the order they were last seen, so both the least recently seen
+        entry and entries that have expired are always at the front of the cache.
+
+        Args:
+            capacity (int): maximum number of IDs tracked at once
+            ttl (float): seconds after which an ID that hasn't been seen is forgotten
+        """
         self.capacity = capacity
-        self.cache = {}
-    
+        self.ttl = int(ttl * 1e9)
+        self.cache = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
     def contains(self, id: int) -> bool:
         """Return true if id is already being tracked."""
         return id in self.cache
-    
+
     def get_tracking_info(self, id: int) -> TrackingInfo:
         """Return the tracking info associated with id. Return None if id is not being tracked."""
         if id in self.cache:
@@ -25,20 +56,34 @@ class ObjectTracker:
         else:
             return None
 
-    def start_tracking(self, id: int) -> bool:
+    def update_last_seen(self, id: int, now: int = None) -> TrackingInfo:
+        """Record that id was detected at now (default: the current time) and return its tracking info.
+
+        Return None if id is not being tracked.
+        """
+        tracking_info = self.cache.get(id)
+        if tracking_info is None:
+            return None
+        tracking_info.last_seen = time.monotonic_ns() if now is None else now
+        self.cache.move_to_end(id)
+        return tracking_info
+
+    def start_tracking(self, id: int, now: int = None) -> bool:
         """Start tracking the given object ID.
 
         If the ID is not already being tracked, a new entry is created for it in the cache.
-        The new entry's arrival time is set to the current time and its flag for a message
-        being sent is set to false.
+        The new entry's arrival and last seen times are set to the current time and its flag
+        for a message being sent is set to false.
 
-        If the cache's size is greater than the tracker's capacity after adding the new entry,
-        the entry with the earliest arrival time is removed from the cache.
+        Entries that haven't been seen within the tracker's TTL are removed first. If the
+        cache's size is still greater than the tracker's capacity after adding the new entry,
+        the least recently seen entry is removed from the cache.
 
         If the ID is already being tracked, the cache is unchanged and the return value is False.
 
         Args:
             id (int): tracking ID of the object
+            now (int): time.monotonic_ns() timestamp of the detection, defaults to the current time
 
         Returns:
             bool: False if the ID is already being tracked
@@ -47,33 +92,46 @@ class ObjectTracker:
         if id in self.cache:
             return False
 
+        # Forget objects that are no longer in view
+        if now is None:
+            now = time.monotonic_ns()
+        self.remove_expired_objects(now)
+
         # Create new entry
         tracking_info = TrackingInfo(
-            arrival_time=datetime.datetime.now(),
-            message_sent=False
+            arrival_time=now,
+            message_sent=False,
+            last_seen=now
         )
         self.cache[id] = tracking_info
 
         # Remove oldest entry, if necessary
         if len(self.cache) > self.capacity:
             self.remove_oldest_object()
+            self.evictions += 1
 
         # Signal success
         return True
 
+    def remove_expired_objects(self, now: int = None) -> int:
+        """Remove entries that haven't been seen within the TTL and return how many were removed."""
+        if now is None:
+            now = time.monotonic_ns()
+        removed = 0
+        while self.cache:
+            oldest_info = next(iter(self.cache.values()))
+            if now - oldest_info.last_seen < self.ttl:
+                break
+            self.cache.popitem(last=False)
+            removed += 1
+        self.expirations += removed
+        return removed
+
     def remove_oldest_object(self) -> None:
-        """Remove the entry with the earliest arrival time from the cache."""
+        """Remove the least recently seen entry from the cache."""
         # Check for empty cache
         if len(self.cache) <= 0:
             return
 
-        # Find the oldest entry
-        items = iter(self.cache.items())
-        oldest_id, oldest_info = next(items)
-        for id, tracking_info in items:
-            if tracking_info.arrival_time < oldest_info.arrival_time:
-                oldest_id = id
-                oldest_info = tracking_info
-
         # Remove oldest entry from the cache
-        self.cache.pop(oldest_id)
+        self.cache.popitem(last=False)
@@ -0,0 +1,255 @@
+"""Replays DeepStream detection messages through the analyzer's message handler without IoT Edge.
+
+Messages come from recorded files or a synthetic generator and are passed to the same handler
+the module registers on its IoTHubModuleClient, with a local stand-in client that records
+outputs and method calls instead of sending them. Detection times are simulated, so replays
+run as fast as the handler allows.
+
+Recorded files hold one nvmsgconv JSON message per line. Each message's "@timestamp" is used
+as its detection time; messages without one are spaced 1/--fps seconds apart.
+
+Usage:
+    python3 replay.py --synthetic --duration 60 --objects 20
+    python3 replay.py recorded/*.jsonl --min-throughput 5000
+"""
+import argparse
+import asyncio
+import datetime
+import gzip
+import json
+import random
+import resource
+import sys
+import time
+import tracemalloc
+import uuid
+
+import main as analyzer
+
+BIRD_SPECIES = ["American Robin", "Black-capped Chickadee", "Blue Jay", "Dark-eyed Junco", "House Finch", "Northern Cardinal"]
+OTHER_CLASSES = ["person", "vehicle"]
+
+
+class ReplayMessage:
+    """Stand-in for azure.iot.device.Message as received on a module input."""
+
+    def __init__(self, data: bytes, input_name: str = "detection_messages") -> None:
+        self.data = data
+        self.input_name = input_name
+
+
+class ReplayModuleClient:
+    """Stand-in for IoTHubModuleClient that records what the handler sends.
+
+    Args:
+        method_latency (float): seconds each invoke_method call takes to return
+    """
+
+    def __init__(self, method_latency: float = 0.0) -> None:
+        self.method_latency = method_latency
+        self.outputs = {} # output name -> list of messages
+        self.method_calls = []
+
+    async def send_message_to_output(self, message, output_name):
+        self.outputs.setdefault(output_name, []).append(message)
+
+    async def invoke_method(self, method_params, device_id):
+        if self.method_latency:
+            await asyncio.sleep(self.method_latency)
+        self.method_calls.append((device_id, method_params))
+        return {"status": 200, "payload": {"result": True}}
+
+    async def get_twin(self):
+        return {"desired": {}, "reported": {}}
+
+    def count_visits(self) -> int:
+        """Return the number of visits sent to bird_visits, unpacking batched messages."""
+        visits = 0
+        for message in self.outputs.get("bird_visits", []):
+            if isinstance(message, str):
+                visits += 1
+                continue
+            body = message.data
+            if message.custom_properties.get("batch-encoding") == "gzip":
+                body = gzip.decompress(body)
+            visits += len(json.loads(body))
+        return visits
+
+
+def parse_timestamp(timestamp: str) -> int:
+    """Return an nvmsgconv "@timestamp" as nanoseconds since the epoch."""
+    parsed = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    return int(parsed.timestamp() * 1e9)
+
+
+def read_recorded(paths, fps: float):
+    """Yield (detection time in ns, message bytes) for each line of the recorded files."""
+    frame_ns = int(1e9 / fps)
+    index = 0
+    for path in paths:
+        with open(path, "rb") as recording:
+            for line in recording:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    detected_at = parse_timestamp(json.loads(line)["@timestamp"])
+                except (KeyError, ValueError):
+                    detected_at = index * frame_ns
+                index += 1
+                yield detected_at, line
+
+
+def synthetic_message(sensor_id: str, tracking_id: int, visitor_class: str, detected_at: int, confidence: float = 0.9) -> bytes:
+    """Return an nvmsgconv-style detection message. visitor_class is a species for birds."""
+    timestamp = datetime.datetime.fromtimestamp(detected_at / 1e9, datetime.timezone.utc)
+    object = {"id": str(tracking_id), "speed": 0.0, "direction": 0.0, "orientation": 0.0}
+    if visitor_class in OTHER_CLASSES:
+        object[visitor_class] = {}
+    else:
+        object["bird"] = {"species": visitor_class, "confidence": confidence}
+    object["bbox"] = {"topleftx": 0, "toplefty": 0, "bottomrightx": 100, "bottomrighty": 100}
+    message = {
+        "messageid": str(uuid.uuid4()),
+        "mdsversion": "1.0",
+        "@timestamp": timestamp.isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+        "sensor": {
+            "id": sensor_id,
+            "type": "FeederCamera",
+            "description": "Synthetic camera",
+            "location": {"lat": 45.293701447, "lon": -75.8303914499, "alt": 48.1557479338},
+            "coordinate": {"x": 5.2, "y": 10.1, "z": 11.225}
+        },
+        "object": object,
+        "event": {"id": str(uuid.uuid4()), "type": "entry"},
+        "videoPath": ""
+    }
+    return json.dumps(message).encode()
+
+
+def generate_synthetic(duration: float, fps: float, objects: int, non_bird_ratio: float, sensors: int = 1, misclassify_ratio: float = 0.0, seed: int = 0):
+    """Yield (detection time in ns, message bytes) for a synthetic detection stream.
+
+    Each sensor sees `objects` objects at a time. Every object is detected once per frame for
+    a random lifetime of 0.5 to 10 seconds and is then replaced by a new object with a new
+    tracking ID. Like DeepStream's, tracking IDs are only unique per sensor. A fraction
+    misclassify_ratio of bird detections report a random species with low confidence.
+    """
+    rng = random.Random(seed)
+    frame_ns = int(1e9 / fps)
+    start = time.time_ns()
+    next_ids = [0] * sensors
+    visible = []
+    for sensor in range(sensors):
+        for _ in range(objects):
+            visible.append([sensor, next_ids[sensor], None, 0])
+            next_ids[sensor] += 1
+
+    for frame in range(int(duration * fps)):
+        now = start + frame * frame_ns
+        for track in visible:
+            sensor, tracking_id, visitor_class, expires_at = track
+            if visitor_class is None or now >= expires_at:
+                # Replace the object that left with a new one
+                tracking_id = next_ids[sensor]
+                next_ids[sensor] += 1
+                visitor_class = rng.choice(OTHER_CLASSES) if rng.random() < non_bird_ratio else rng.choice(BIRD_SPECIES)
+                expires_at = now + int(rng.uniform(0.5, 10.0) * 1e9)
+                track[1:] = [tracking_id, visitor_class, expires_at]
+            confidence = 0.9
+            if visitor_class in BIRD_SPECIES and rng.random() < misclassify_ratio:
+                visitor_class, confidence = rng.choice(BIRD_SPECIES), rng.uniform(0.2, 0.6)
+            yield now, synthetic_message(f"SmartFeeder{sensor + 1}", tracking_id, visitor_class, now, confidence)
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def replay(messages, client: ReplayModuleClient) -> dict:
+    """Pass every message through the analyzer's handler and return throughput and latency statistics."""
+    handler = analyzer.create_message_handler(client)
+    # Shift detection times onto the monotonic clock, so visit timestamps convert as they would live
+    clock_offset = None
+    simulated_now = time.monotonic_ns()
+    analyzer.clock = lambda: simulated_now
+
+    latencies = []
+    started = time.perf_counter()
+    for detected_at, data in messages:
+        if clock_offset is None:
+            clock_offset = simulated_now - detected_at
+        simulated_now = detected_at + clock_offset
+        message = ReplayMessage(data)
+        handle_start = time.perf_counter_ns()
+        await handler(message)
+        latencies.append(time.perf_counter_ns() - handle_start)
+        # Let the output queue's senders run, as they would between messages from IoT Edge
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+
+    # Send anything still batched or queued
+    await analyzer.flush_outputs(handler)
+
+    latencies.sort()
+    return {
+        "messages": len(latencies),
+        "seconds": elapsed,
+        "messages_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_latency_us": percentile(latencies, 0.50) / 1000,
+        "p99_latency_us": percentile(latencies, 0.99) / 1000,
+        "visits": client.count_visits(),
+        "bird_visits_messages": len(client.outputs.get("bird_visits", [])),
+        "method_calls": len(client.method_calls),
+        "outputs_dropped": analyzer.output_queue.dropped,
+        "streams": len(analyzer.stream_trackers.streams),
+        "tracked_objects": sum(len(stream.tracker.cache) for stream in analyzer.stream_trackers.streams.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="*", help="recorded detection messages, one JSON message per line")
+    parser.add_argument("--synthetic", action="store_true", help="generate messages instead of reading files")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds of synthetic detections")
+    parser.add_argument("--fps", type=float, default=30.0, help="frames per second")
+    parser.add_argument("--objects", type=int, default=5, help="objects visible at once per synthetic camera")
+    parser.add_argument("--sensors", type=int, default=1, help="number of synthetic cameras")
+    parser.add_argument("--non-bird-ratio", type=float, default=0.1, help="fraction of synthetic objects that aren't birds")
+    parser.add_argument("--misclassify-ratio", type=float, default=0.0, help="fraction of synthetic bird detections with a random species")
+    parser.add_argument("--method-latency", type=float, default=0.0, help="seconds each direct method call takes")
+    parser.add_argument("--trace-memory", action="store_true", help="report peak Python allocations (slows the replay)")
+    parser.add_argument("--min-throughput", type=float, default=0.0, help="exit with an error below this many messages per second")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        # Generate up front so message construction isn't part of the measurement
+        messages = list(generate_synthetic(args.duration, args.fps, args.objects, args.non_bird_ratio, args.sensors, args.misclassify_ratio))
+    elif args.files:
+        messages = list(read_recorded(args.files, args.fps))
+    else:
+        parser.error("give recorded files or --synthetic")
+
+    if args.trace_memory:
+        tracemalloc.start()
+    client = ReplayModuleClient(method_latency=args.method_latency)
+    results = asyncio.get_event_loop().run_until_complete(replay(messages, client))
+    if args.trace_memory:
+        results["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    # ru_maxrss is in kilobytes on Linux
+    results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    for name, value in results.items():
+        print(f"{name:<24}{value:>14.2f}" if isinstance(value, float) else f"{name:<24}{value:>14}")
+
+    if results["messages_per_second"] < args.min_throughput:
+        print(f"Throughput below {args.min_throughput} messages/second")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+from typing import Optional, Tuple
+
+
+class SpeciesVotes:
+    """Species classifications of one tracked bird, accumulated over the frames it was seen in.
+
+    Each classification is a vote weighted by the classifier's confidence. At most
+    max_candidates species are kept: when another species is voted for, the candidate with
+    the least weight is replaced, so a noisy classifier can't grow a track's memory.
+    """
+    __slots__ = ("weights", "votes", "total_weight", "max_candidates")
+
+    def __init__(self, max_candidates: int = 4) -> None:
+        self.weights = {} # species -> sum of the confidences of its votes
+        self.votes = 0
+        self.total_weight = 0.0
+        self.max_candidates = max_candidates
+
+    def add(self, species: str, confidence: float = 1.0) -> None:
+        """Record a classification of the bird as species."""
+        self.votes += 1
+        self.total_weight += confidence
+        weights = self.weights
+        if species in weights:
+            weights[species] += confidence
+            return
+        if len(weights) >= self.max_candidates:
+            least_likely = min(weights, key=weights.get)
+            if weights[least_likely] > confidence:
+                return
+            del weights[least_likely]
+        weights[species] = confidence
+
+    def decide(self) -> Tuple[Optional[str], float]:
+        """Return the species with the most weight and its share of the weight of all votes.
+
+        Returns:
+            tuple: the species, or None if there were no votes, and a confidence from 0 to 1
+        """
+        if not self.weights:
+            return None, 0.0
+        species = max(self.weights, key=self.weights.get)
+        if self.total_weight <= 0:
+            return species, 0.0
+        return species, self.weights[species] / self.total_weight
@@ -0,0 +1,72 @@
+from typing import Dict, Optional
+
+from object_tracker import ObjectTracker
+
+
+class Stream:
+    """Tracking state and counters of one camera, identified by its nvmsgconv sensor ID."""
+    __slots__ = ("sensor_id", "tracker", "messages", "visits", "alerts")
+
+    def __init__(self, sensor_id: str, tracker: ObjectTracker) -> None:
+        self.sensor_id = sensor_id
+        self.tracker = tracker
+        self.messages = 0
+        self.visits = 0
+        self.alerts = 0
+
+    def stats(self) -> dict:
+        """Return the stream's message, visit and alert counts and the state of its tracker."""
+        return {
+            "messages": self.messages,
+            "visits": self.visits,
+            "alerts": self.alerts,
+            "tracked": len(self.tracker.cache),
+            "evictions": self.tracker.evictions,
+            "expirations": self.tracker.expirations,
+        }
+
+
+class StreamTrackers:
+    """Keeps a separate ObjectTracker for each camera.
+
+    DeepStream tracking IDs are only unique within a source, so objects from different
+    cameras must be tracked separately or their IDs would collide. Each camera's sensor ID
+    (the feeder's device ID) selects its stream. Streams are created on their first message,
+    up to max_streams, so a misconfigured pipeline can't grow the analyzer's memory without
+    bound.
+    """
+
+    def __init__(self, capacity: int = 1000, ttl: float = 5.0, max_streams: int = 16) -> None:
+        """Create an empty set of streams.
+
+        Args:
+            capacity (int): maximum number of IDs tracked at once for each stream
+            ttl (float): seconds after which an ID that hasn't been seen is forgotten
+            max_streams (int): maximum number of streams
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self.streams: Dict[str, Stream] = {}
+        self.rejected = 0
+
+    def get(self, sensor_id: str) -> Optional[Stream]:
+        """Return the stream of a sensor, creating it if necessary.
+
+        Returns:
+            Stream: the sensor's stream, or None if there are already max_streams other streams
+        """
+        stream = self.streams.get(sensor_id)
+        if stream is None:
+            if len(self.streams) >= self.max_streams:
+                if self.rejected == 0:
+                    print(f"Ignoring messages from sensor {sensor_id}: already tracking {self.max_streams} streams")
+                self.rejected += 1
+                return None
+            stream = Stream(sensor_id, ObjectTracker(capacity=self.capacity, ttl=self.ttl))
+            self.streams[sensor_id] = stream
+        return stream
+
+    def stats(self) -> dict:
+        """Return each stream's statistics, keyed by sensor ID."""
+        return {sensor_id: stream.stats() for sensor_id, stream in self.streams.items()}
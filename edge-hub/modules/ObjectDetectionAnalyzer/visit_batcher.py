@@ -0,0 +1,73 @@
+import asyncio
+import gzip
+import json
+from typing import Callable
+
+from azure.iot.device import Message
+
+# Custom message property marking a message that holds a JSON array of visits, and how it's encoded
+BATCH_ENCODING_PROPERTY = "batch-encoding"
+
+
+class VisitBatcher:
+    """Packs bird visits into one output message, flushed every max_visits visits or max_delay seconds.
+
+    The message body is a JSON array of visit objects, optionally gzip-compressed. Each visit
+    keeps its own visited_at timestamp. The batch-encoding custom property ("json" or "gzip")
+    tells the backend how to unpack it.
+
+    The flush timer is started on the first add, on whichever event loop the caller runs on.
+    """
+
+    def __init__(self, submit: Callable[[Message], None], max_visits: int = 50, max_delay: float = 10.0, compress: bool = False) -> None:
+        """Create an empty batcher.
+
+        Args:
+            submit (Callable): called with each batch message, e.g. to queue it for sending
+            max_visits (int): number of visits that triggers a flush
+            max_delay (float): maximum seconds a visit waits before it is flushed
+            compress (bool): gzip the message body
+        """
+        self.submit = submit
+        self.max_visits = max_visits
+        self.max_delay = max_delay
+        self.compress = compress
+        self.visits = []
+        self.timer = None
+        self.batches = 0
+
+    def add(self, visit: dict) -> None:
+        """Add a visit to the current batch, flushing it if it is full."""
+        if self.timer is None:
+            self.timer = asyncio.ensure_future(self._flush_periodically())
+        self.visits.append(visit)
+        if len(self.visits) >= self.max_visits:
+            self.flush()
+
+    def flush(self) -> None:
+        """Submit the visits batched so far as one message."""
+        if not self.visits:
+            return
+        visits, self.visits = self.visits, []
+        body = json.dumps(visits).encode()
+        if self.compress:
+            body = gzip.compress(body)
+        message = Message(body)
+        message.content_type = "application/json"
+        if not self.compress:
+            message.content_encoding = "utf-8"
+        message.custom_properties[BATCH_ENCODING_PROPERTY] = "gzip" if self.compress else "json"
+        self.submit(message)
+        self.batches += 1
+
+    def close(self) -> None:
+        """Submit the visits batched so far and stop the flush timer."""
+        self.flush()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.max_delay)
+            self.flush()
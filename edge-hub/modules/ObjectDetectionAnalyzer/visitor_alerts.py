@@ -0,0 +1,79 @@
+import time
+from typing import Dict, Iterable, Optional
+from urllib.parse import unquote
+
+# Members of a detected object that describe it rather than name its class
+NON_CLASS_KEYS = {"id", "speed", "direction", "orientation", "bbox", "location", "coordinate", "pose", "embedding", "maskoutline", "signature"}
+
+
+def visitor_classes(object: dict) -> frozenset:
+    """Return the classes of a detected object, i.e. the names of its class sub-objects."""
+    return frozenset(key for key in object if key not in NON_CLASS_KEYS)
+
+
+class VisitorAlertFilter:
+    """Decides which non-bird visitors are worth a checkIfVisitorUnwelcome call to their feeder.
+
+    Each feeder's unwelcome visitors are cached from the module twin, so visitors that are
+    welcome never cause a method call. Feeders whose list isn't known are always asked. Alerts
+    for the same feeder and class are coalesced: after one is sent, the class is ignored for
+    that feeder until the cooldown has passed.
+    """
+
+    def __init__(self, cooldown: float = 30.0) -> None:
+        self.cooldown = int(cooldown * 1e9)
+        self.unwelcome_visitors: Dict[str, frozenset] = {} # device ID -> classes the feeder considers unwelcome
+        self.last_alerts: Dict[tuple, int] = {} # (device ID, class) -> time.monotonic_ns() of the last alert
+        self.sent = 0
+        self.filtered = 0
+        self.coalesced = 0
+
+    def set_unwelcome_visitors(self, device_id: str, visitors: Optional[Iterable[str]]) -> None:
+        """Cache the unwelcome visitors of a feeder. None forgets them, so the feeder is always asked."""
+        if visitors is None:
+            self.unwelcome_visitors.pop(device_id, None)
+        else:
+            self.unwelcome_visitors[device_id] = frozenset(visitors)
+
+    def update_from_twin(self, desired: dict) -> None:
+        """Apply the unwelcomeVisitors desired property, which maps device IDs to lists of classes.
+
+        The device IDs are percent-encoded by the backend, since twin property names can't
+        contain some of the characters device IDs can.
+        """
+        unwelcome_visitors = desired.get("unwelcomeVisitors")
+        if not isinstance(unwelcome_visitors, dict):
+            return
+        for device_id, visitors in unwelcome_visitors.items():
+            self.set_unwelcome_visitors(unquote(device_id), visitors)
+
+    def should_alert(self, device_id: str, object: dict, now: int = None) -> bool:
+        """Return true if the feeder should be asked about this visitor, and record the alert if so."""
+        if now is None:
+            now = time.monotonic_ns()
+        classes = visitor_classes(object)
+        unwelcome = self.unwelcome_visitors.get(device_id)
+        if unwelcome is not None:
+            classes = classes & unwelcome
+            if not classes:
+                # The feeder would only reply that the visitor is welcome
+                self.filtered += 1
+                return False
+
+        # Alert if any of the visitor's classes is out of its cooldown
+        due = []
+        for visitor_class in classes:
+            last_alert = self.last_alerts.get((device_id, visitor_class))
+            if last_alert is None or now - last_alert >= self.cooldown:
+                due.append(visitor_class)
+        if classes and not due:
+            self.coalesced += 1
+            return False
+        for visitor_class in due:
+            self.last_alerts[(device_id, visitor_class)] = now
+        self.sent += 1
+        return True
+
+    def stats(self) -> dict:
+        """Return counts of alerts sent, filtered as welcome and coalesced."""
+        return {"sent": self.sent, "filtered": self.filtered, "coalesced": self.coalesced}
@@ -0,0 +1,94 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+
+class WorkQueue:
+    """Bounded queue of async jobs run by a fixed number of concurrent workers.
+
+    Submitting a job never waits, so a slow job (such as a direct method call with a long
+    response timeout) can't hold up the code that submits work. When the queue is full, the
+    oldest queued job is dropped to make room for the new one.
+
+    The queue and its workers are created on the first submit, on whichever event loop the
+    submitter runs on.
+    """
+
+    def __init__(self, maxsize: int = 100, num_workers: int = 4) -> None:
+        self.maxsize = maxsize
+        self.num_workers = num_workers
+        self.queue = None
+        self.workers = []
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.total_wait = 0.0 # seconds jobs spent queued before a worker picked them up
+
+    def submit(self, job: Callable[[], Awaitable]) -> None:
+        """Queue a coroutine function to be called by a worker."""
+        if self.queue is None:
+            self._start()
+        if self.queue.full():
+            # Drop the oldest job to make room
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.dropped += 1
+        self.queue.put_nowait((time.monotonic(), job))
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def _start(self) -> None:
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.workers = [asyncio.ensure_future(self._work()) for _ in range(self.num_workers)]
+
+    async def _work(self) -> None:
+        while True:
+            queued_at, job = await self.queue.get()
+            self.total_wait += time.monotonic() - queued_at
+            try:
+                await job()
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Queued job failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def drain(self, timeout: float = None) -> bool:
+        """Wait up to timeout seconds for every queued job to run, then stop the workers.
+
+        Returns:
+            bool: False if jobs were still queued or running when the timeout passed
+        """
+        drained = True
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                drained = False
+        await self.stop()
+        return drained
+
+    async def stop(self) -> None:
+        """Cancel the workers. Jobs still queued are discarded."""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def stats(self) -> dict:
+        """Return queue depth and job counts."""
+        started = self.completed + self.failed
+        return {
+            "depth": 0 if self.queue is None else self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "capacity": self.maxsize,
+            "workers": self.num_workers,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "mean_wait_seconds": self.total_wait / started if started else 0.0,
+        }
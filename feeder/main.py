@@ -12,9 +12,16 @@ The original copyright notice is preserved below.
 
 import os
 import asyncio
+import json
+import math
+import sqlite3
+import statistics
+import threading
+import time
+from collections import deque
 from six.moves import input
 from azure.iot.device.aio import IoTHubDeviceClient
-from azure.iot.device import MethodResponse
+from azure.iot.device import Message, MethodResponse
 import board
 import busio
 import adafruit_vl53l0x
@@ -26,53 +33,469 @@ MAX_DIST = 135
 MIN_DIST = 110
 FOOD_POLL = 5
 
+# Default config values for adaptive polling - the food poll interval is the fastest rate
+ADAPTIVE_FOOD_POLL = os.getenv("ADAPTIVE_FOOD_POLL", "true").lower() == "true"
+MAX_FOOD_POLL = 300
+CONSUMPTION_WINDOW = float(os.getenv("CONSUMPTION_RATE_SECONDS", "120"))
+REFILL_THRESHOLD = 0.1
+
 # Default config values for alarm
 BUZZER_PIN = 26
 ALARM_INTERVAL = 0.5
 ALARM_REPS = 5 
+ALARM_COOLDOWN = float(os.getenv("ALARM_COOLDOWN", "10"))
 UNWELCOME_VISITORS = ["bear", "cat", "dog"]
 
+# Default config values for reporting
+FOOD_LEVEL_DEADBAND = float(os.getenv("FOOD_LEVEL_DEADBAND", "0.02"))
+FOOD_LEVEL_HEARTBEAT = float(os.getenv("FOOD_LEVEL_HEARTBEAT", "3600"))
+TIME_TO_EMPTY_CHANGE = float(os.getenv("TIME_TO_EMPTY_CHANGE", "0.25"))
+REPORT_FLUSH_WINDOW = float(os.getenv("REPORT_FLUSH_SECONDS", "1.0"))
+
+# Default config values for store-and-forward of food levels measured while offline
+TELEMETRY_BUFFER_PATH = os.getenv("TELEMETRY_BUFFER_PATH", "telemetry.db")
+TELEMETRY_BUFFER_ROWS = int(os.getenv("TELEMETRY_BUFFER_ROWS", "10000"))
+TELEMETRY_BATCH_SIZE = int(os.getenv("TELEMETRY_BATCH_SIZE", "100"))
+TELEMETRY_DRAIN_INTERVAL = float(os.getenv("TELEMETRY_DRAIN_SECONDS", "60"))
+
+# Default config values for distance sampling
+TIMING_BUDGET = 800000 # microseconds per reading
+SAMPLES_PER_POLL = int(os.getenv("DISTANCE_SAMPLES_PER_POLL", "3"))
+SAMPLE_INTERVAL = float(os.getenv("DISTANCE_SAMPLE_INTERVAL", "0"))
+SAMPLE_WINDOW = int(os.getenv("DISTANCE_SAMPLE_WINDOW", "9"))
+SAMPLE_WINDOW_SECONDS = float(os.getenv("DISTANCE_WINDOW_SECONDS", "10"))
+MIN_WINDOW_SAMPLES = 3
+SAMPLE_FILTER = os.getenv("DISTANCE_FILTER", "median")
+EMA_ALPHA = float(os.getenv("DISTANCE_EMA_ALPHA", "0.3"))
+# The VL53L0X reports readings at or above this many millimeters when nothing is in range
+OUT_OF_RANGE = 8000
+
 class DistanceSensor:
-    def __init__(self):
+    """Samples the distance sensor on a background thread.
+
+    Each reading blocks for the sensor's measurement timing budget (0.8 s), so readings are
+    taken on their own thread and kept in a ring buffer. range() returns the filtered
+    distance immediately: either the median of the recent readings or an exponential moving
+    average of them. Readings the sensor reports as out of range are discarded.
+
+    The filter covers the readings of the last window_seconds, but at least the newest
+    MIN_WINDOW_SAMPLES of them, so it doesn't lag further behind when readings are spaced
+    out while the feeder is idle.
+    """
+    def __init__(self, sample_interval=SAMPLE_INTERVAL, window=SAMPLE_WINDOW, filter=SAMPLE_FILTER, ema_alpha=EMA_ALPHA, window_seconds=SAMPLE_WINDOW_SECONDS):
         i2c = busio.I2C(board.SCL, board.SDA)
         self.sensor = adafruit_vl53l0x.VL53L0X(i2c)
-        self.sensor.measurement_timing_budget = 800000
-    
+        self.sensor.measurement_timing_budget = TIMING_BUDGET
+        self.sample_interval = sample_interval
+        self.filter = filter
+        self.ema_alpha = ema_alpha
+        self.window_seconds = window_seconds
+        self.samples = deque(maxlen=window) # (time.monotonic() of the reading, distance)
+        self.ema = None
+        self.ema_at = None
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.sampled = threading.Event()
+        self.stopped = threading.Event()
+        self.rescheduled = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        while not self.stopped.is_set():
+            try:
+                distance = self.sensor.range
+            except Exception as e:
+                print(f"Failed to read distance sensor: {e}")
+                distance = None
+            if distance is None or distance <= 0 or distance >= OUT_OF_RANGE:
+                self.rejected += 1
+            else:
+                now = time.monotonic()
+                with self.lock:
+                    self.samples.append((now, distance))
+                    if self.ema is None:
+                        self.ema = distance
+                    else:
+                        # Weigh a reading more the longer it has been since the last one
+                        weight = max(self.ema_alpha, 1.0 - math.exp(-(now - self.ema_at) / self.window_seconds))
+                        self.ema += weight * (distance - self.ema)
+                    self.ema_at = now
+                self.sampled.set()
+            self.rescheduled.wait(self.sample_interval)
+            self.rescheduled.clear()
+
+    def set_sample_interval(self, sample_interval):
+        """Change the pause between readings, cutting short the current pause."""
+        if sample_interval != self.sample_interval:
+            self.sample_interval = sample_interval
+            self.rescheduled.set()
+
+    def wait_for_sample(self, timeout=None):
+        """Block until the first reading has been taken. Return False if the timeout passed first."""
+        return self.sampled.wait(timeout)
+
     def range(self):
-        return self.sensor.range
+        """Return the filtered distance in millimeters, or None if there are no readings yet."""
+        with self.lock:
+            if not self.samples:
+                return None
+            if self.filter == "ema":
+                return self.ema
+            oldest = time.monotonic() - self.window_seconds
+            recent = [distance for taken_at, distance in self.samples if taken_at >= oldest]
+            if len(recent) < MIN_WINDOW_SAMPLES:
+                recent = [distance for _, distance in list(self.samples)[-MIN_WINDOW_SAMPLES:]]
+            return statistics.median(recent)
+
+    def stop(self):
+        self.stopped.set()
+        self.rescheduled.set()
 
 
 class Alarm:
-    def __init__(self, buzzer_pin=BUZZER_PIN) -> None:
+    """Sounds the buzzer from a background task, so that whoever triggers it doesn't wait for it.
+
+    Triggering the alarm while it sounds re-arms it: it sounds for the full number of
+    repetitions again from that point. Once it has finished or been silenced, triggers are
+    ignored until the cooldown has passed. trigger() and cancel() can be called from any
+    thread, including the client's handler threads; the buzzer is driven from the loop the
+    alarm was created on.
+    """
+    def __init__(self, buzzer_pin=BUZZER_PIN, interval=ALARM_INTERVAL, repetitions=ALARM_REPS, cooldown=ALARM_COOLDOWN) -> None:
         self.buzzer_pin = buzzer_pin
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(buzzer_pin, GPIO.OUT, initial=GPIO.LOW)
-        self.sounding_alarm = False
-
-    async def sound_alarm(self, interval=ALARM_INTERVAL, repetitions=ALARM_REPS):
-        if not self.sounding_alarm:
-            self.sounding_alarm = True
-            for _ in range(repetitions):
-                GPIO.output(self.buzzer_pin, GPIO.HIGH)
-                await asyncio.sleep(interval)
-                GPIO.output(self.buzzer_pin, GPIO.LOW)
-                await asyncio.sleep(interval)
-            self.sounding_alarm = False
+        self.interval = interval
+        self.repetitions = repetitions
+        self.cooldown = cooldown
+        self.loop = asyncio.get_running_loop()
+        self.lock = threading.Lock()
+        self.task = None
+        self.sounding = False
+        self.remaining = 0
+        self.finished_at = None
+
+    def trigger(self):
+        """Sound the alarm, or re-arm it if it is already sounding.
+
+        Returns:
+            str: "sounding" if the alarm was started, "rearmed" if it was already sounding, or
+                "cooldown" if it was ignored because the alarm sounded too recently
+        """
+        with self.lock:
+            if self.sounding:
+                self.remaining = self.repetitions
+                return "rearmed"
+            if self.finished_at is not None and time.monotonic() - self.finished_at < self.cooldown:
+                return "cooldown"
+            self.sounding = True
+            self.remaining = self.repetitions
+        self.loop.call_soon_threadsafe(self._start)
+        return "sounding"
+
+    def cancel(self):
+        """Silence the alarm if it is sounding."""
+        with self.lock:
+            # Finish now rather than when the task is cancelled, so a trigger in between isn't
+            # counted as a re-arm of an alarm that is about to stop
+            if self.sounding:
+                self._finish()
+        self.loop.call_soon_threadsafe(self._cancel)
+
+    def status(self):
+        """Return whether the alarm is sounding and how long until it can be triggered again."""
+        with self.lock:
+            cooldown_remaining = 0.0
+            if not self.sounding and self.finished_at is not None:
+                cooldown_remaining = max(self.cooldown - (time.monotonic() - self.finished_at), 0.0)
+            return {"sounding": self.sounding, "cooldownRemaining": round(cooldown_remaining, 1)}
+
+    def _start(self):
+        self.task = asyncio.ensure_future(self._sound())
+        # A done callback also runs if the task is cancelled before it starts
+        self.task.add_done_callback(self._on_done)
+
+    def _cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def _finish(self):
+        # Must be called with the lock held
+        self.sounding = False
+        self.remaining = 0
+        self.finished_at = time.monotonic()
+
+    def _on_done(self, task):
+        GPIO.output(self.buzzer_pin, GPIO.LOW)
+        if self.task is not task:
+            # A newer alarm has started since, and its state isn't this task's to clear
+            return
+        self.task = None
+        if task.cancelled() or task.exception() is not None:
+            # Stopped before running out of repetitions, e.g. by an error or by cancel() before
+            # the task started, so the alarm may still be marked as sounding. A task that
+            # finished normally has already cleared it.
+            with self.lock:
+                if self.sounding:
+                    self._finish()
+
+    async def _sound(self):
+        while True:
+            with self.lock:
+                # Deciding to stop and clearing sounding together means a trigger is either
+                # counted as a re-arm or starts a new alarm, never lost in between
+                if self.remaining <= 0:
+                    self._finish()
+                    return
+                self.remaining -= 1
+            GPIO.output(self.buzzer_pin, GPIO.HIGH)
+            await asyncio.sleep(self.interval)
+            GPIO.output(self.buzzer_pin, GPIO.LOW)
+            await asyncio.sleep(self.interval)
+
+
+class ConsumptionEstimator:
+    """Estimates how fast the food level is falling from successive food levels.
+
+    The rate is an exponentially weighted moving average of the drop between readings with a
+    time constant of window seconds, so it is updated in constant time, follows changes in
+    feeding activity and weights readings by the time between them however often the feeder
+    polls. A rise of more than the refill threshold is taken as the feeder being refilled and
+    resets the rate.
+    """
+    def __init__(self, window=CONSUMPTION_WINDOW, refill_threshold=REFILL_THRESHOLD) -> None:
+        self.window = window
+        self.refill_threshold = refill_threshold
+        self.rate = 0.0 # fraction of a full feeder eaten per second
+        self.last_drop = 0.0
+        self.last_level = None
+        self.last_time = None
+
+    def update(self, level, now):
+        """Record the food level at time now (in seconds)."""
+        if self.last_level is not None and now > self.last_time:
+            drop = self.last_level - level
+            self.last_drop = drop
+            if drop < -self.refill_threshold:
+                self.rate = 0.0
+            else:
+                elapsed = now - self.last_time
+                weight = 1.0 - math.exp(-elapsed / self.window)
+                self.rate += weight * (drop / elapsed - self.rate)
+        self.last_level = level
+        self.last_time = now
+
+    def consumption_rate(self):
+        """Return the estimated fraction of a full feeder eaten per second."""
+        return max(self.rate, 0.0)
+
+    def time_to_empty(self, level):
+        """Return the projected seconds until the feeder is empty, or None if it isn't being emptied."""
+        rate = self.consumption_rate()
+        if rate <= 0.0:
+            return None
+        return level / rate
+
+
+def merge_patch(target, patch):
+    """Merge a reported properties patch into target, recursing into nested dicts."""
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+class ReportedProperties:
+    """Coalesces reported property changes into one twin patch per flush window.
+
+    Changes are merged as they're made and sent together flush_window seconds after the first
+    of them, so several changes in quick succession cost one IoT Hub operation. If sending
+    fails, the changes are kept and sent with the next window's. update() can be called from
+    any thread, including the client's handler threads.
+    """
+    def __init__(self, client, flush_window=REPORT_FLUSH_WINDOW) -> None:
+        self.client = client
+        self.flush_window = flush_window
+        self.loop = asyncio.get_running_loop()
+        self.pending = {}
+        self.flush_task = None
+        self.updates = 0
+        self.patches_sent = 0
+
+    def update(self, patch):
+        """Queue a change to the reported properties."""
+        self.loop.call_soon_threadsafe(self._update, patch)
+
+    def _update(self, patch):
+        merge_patch(self.pending, patch)
+        self.updates += 1
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_window)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Send the pending changes now."""
+        if not self.pending:
+            return
+        patch, self.pending = self.pending, {}
+        try:
+            await self.client.patch_twin_reported_properties(patch)
+            self.patches_sent += 1
+        except Exception as e:
+            print(f"Failed to report properties, retrying in {self.flush_window} seconds: {e}")
+            # Keep the changes, under any made while sending
+            self.pending = merge_patch(patch, self.pending)
+            if self.flush_task is None:
+                self.flush_task = asyncio.create_task(self._flush_later())
+
+
+class TelemetryBuffer:
+    """Bounded ring buffer of food level samples in a SQLite file.
+
+    Appending is a single insert into a rowid table, and rows older than the newest capacity
+    rows are deleted by rowid range as new ones are added, so the file stays a bounded size.
+    The database uses write-ahead logging without syncing every commit, to spare the SD card.
+    """
+    def __init__(self, path=TELEMETRY_BUFFER_PATH, capacity=TELEMETRY_BUFFER_ROWS) -> None:
+        self.capacity = capacity
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS samples ("
+            "id INTEGER PRIMARY KEY, measured_at TEXT NOT NULL, food_level REAL NOT NULL, time_to_empty INTEGER)"
+        )
+        self.db.commit()
+
+    def append(self, measured_at, food_level, time_to_empty=None):
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO samples (measured_at, food_level, time_to_empty) VALUES (?, ?, ?)",
+                (measured_at, food_level, time_to_empty)
+            )
+            # Drop the oldest samples beyond the capacity
+            self.db.execute("DELETE FROM samples WHERE id <= ?", (cursor.lastrowid - self.capacity,))
+
+    def oldest(self, limit):
+        """Return up to limit of the oldest samples as (id, measured_at, food_level, time_to_empty) tuples."""
+        return self.db.execute(
+            "SELECT id, measured_at, food_level, time_to_empty FROM samples ORDER BY id LIMIT ?", (limit,)
+        ).fetchall()
+
+    def remove_through(self, id):
+        """Remove the samples up to and including id."""
+        with self.db:
+            self.db.execute("DELETE FROM samples WHERE id <= ?", (id,))
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+class StoreAndForward:
+    """Keeps the food levels measured while the feeder is offline and sends them once it reconnects.
+
+    Reported properties only hold the latest food level, so levels measured while the client
+    is disconnected are stored in a TelemetryBuffer. When the client reconnects (and every
+    drain_interval seconds, in case a reconnection is missed), they are sent as device-to-cloud
+    messages of up to batch_size samples each, oldest first, and removed once sent. Each message
+    carries the feeder's device ID and a "message-type" property of "foodLevelHistory", which
+    the backend routes on.
+    """
+    def __init__(self, client, buffer, device_id, batch_size=TELEMETRY_BATCH_SIZE, drain_interval=TELEMETRY_DRAIN_INTERVAL) -> None:
+        self.client = client
+        self.buffer = buffer
+        self.device_id = device_id
+        self.batch_size = batch_size
+        self.drain_interval = drain_interval
+        self.loop = asyncio.get_running_loop()
+        self.reconnected = asyncio.Event()
+        self.stored = 0
+        self.forwarded = 0
+
+    def record(self, food_level, time_to_empty=None):
+        """Store a food level if the client can't currently report it."""
+        if self.client.connected:
+            return
+        self.buffer.append(datetime.datetime.now(datetime.timezone.utc).isoformat(), food_level, time_to_empty)
+        self.stored += 1
+
+    def on_connection_state_change(self):
+        # Called by the client, possibly from another thread
+        if self.client.connected:
+            self.loop.call_soon_threadsafe(self.reconnected.set)
+
+    async def drain(self):
+        """Send the stored food levels until none are left or sending fails."""
+        while self.client.connected:
+            samples = self.buffer.oldest(self.batch_size)
+            if not samples:
+                return
+            body = {
+                "device_id": self.device_id,
+                "foodLevelHistory": [
+                    {"measuredAt": measured_at, "foodLevel": food_level, "timeToEmpty": time_to_empty}
+                    for _, measured_at, food_level, time_to_empty in samples
+                ]
+            }
+            message = Message(json.dumps(body))
+            message.content_type = "application/json"
+            message.content_encoding = "utf-8"
+            message.custom_properties["message-type"] = "foodLevelHistory"
+            try:
+                await self.client.send_message(message)
+            except Exception as e:
+                print(f"Failed to send stored food levels: {e}")
+                return
+            self.buffer.remove_through(samples[-1][0])
+            self.forwarded += len(samples)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.reconnected.wait(), timeout=self.drain_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.reconnected.clear()
+            await self.drain()
 
 
 class Feeder:
-    def __init__(self, max_food_distance, min_food_distance, food_poll_interval, buzzer_pin=BUZZER_PIN, unwelcome_visitors=[]) -> None:
+    def __init__(self, max_food_distance, min_food_distance, food_poll_interval, buzzer_pin=BUZZER_PIN, unwelcome_visitors=[],
+                 food_level_deadband=FOOD_LEVEL_DEADBAND, food_level_heartbeat=FOOD_LEVEL_HEARTBEAT, max_food_poll_interval=MAX_FOOD_POLL,
+                 time_to_empty_change=TIME_TO_EMPTY_CHANGE) -> None:
         self.distance_sensor = DistanceSensor()
+        self.food_level_deadband = food_level_deadband
+        self.food_level_heartbeat = food_level_heartbeat
+        self.time_to_empty_change = time_to_empty_change
         self.max_food_distance = max_food_distance
         self.min_food_distance = min_food_distance
         self.max_food_height = max_food_distance - min_food_distance
         self.food_poll_interval = food_poll_interval
+        self.max_food_poll_interval = max_food_poll_interval
+        self.adaptive_polling = ADAPTIVE_FOOD_POLL
+        self.consumption = ConsumptionEstimator()
+        self.food_level = None
+        # Only wait for the sensor at startup; afterwards the latest reading is always used
+        self.distance_sensor.wait_for_sample(timeout=10)
         self.update_food_level()
         self.alarm = Alarm(buzzer_pin)
         self.set_unwelcome_visitors(unwelcome_visitors)
 
     def update_food_level(self):
         cur_distance = self.distance_sensor.range()
+        if cur_distance is None:
+            # No readings yet - keep the previous level
+            return
         cur_height = self.max_food_distance - cur_distance
         calculated_food_level = cur_height / self.max_food_height
         self.food_level = max(min(calculated_food_level, 1.0), 0.0)
@@ -83,18 +506,73 @@ class Feeder:
     def set_food_pool_interval(self, new_interval):
         self.food_poll_interval = new_interval
 
+    def set_max_food_poll_interval(self, new_interval):
+        self.max_food_poll_interval = new_interval
+
     def set_unwelcome_visitors(self, new_unwelcome_visitors):
         self.unwelcome_visitors = set(new_unwelcome_visitors)
 
-    async def send_periodic_food_level_updates(self, client):
+    def next_poll_interval(self, interval):
+        """Return the seconds to wait before the next poll, given the current interval.
+
+        Polls are timed so that the food level is expected to fall by about the reporting
+        deadband between them, between the food poll interval and the maximum interval. The
+        interval drops to the food poll interval as soon as the level falls by more than the
+        deadband between two polls, and at most doubles per poll when feeding slows down.
+        """
+        if not self.adaptive_polling or self.consumption.last_drop > self.food_level_deadband:
+            return self.food_poll_interval
+        rate = self.consumption.consumption_rate()
+        target = self.food_level_deadband / rate if rate > 0.0 else self.max_food_poll_interval
+        target = min(target, interval * 2, self.max_food_poll_interval)
+        return max(target, self.food_poll_interval)
+
+    def time_to_empty_changed(self, reported, current):
+        """Return True if the time to empty has changed by more than time_to_empty_change of the reported value."""
+        if reported is None or current is None:
+            return reported != current
+        return abs(current - reported) > self.time_to_empty_change * reported
+
+    async def send_periodic_food_level_updates(self, reporter, history=None):
+        # Only report the level when it or the time to empty has changed materially, or when
+        # it hasn't been reported for the heartbeat interval
+        last_reported_level = None
+        last_reported_time_to_empty = None
+        last_report_time = None
+        interval = self.food_poll_interval
         while True:
-            self.update_food_level()
-            reported_level = {"foodLevel": self.food_level}
-            await client.patch_twin_reported_properties(reported_level)
-            await asyncio.sleep(self.food_poll_interval)
-
-    async def sound_alarm(self):
-        await self.alarm.sound_alarm()
+            try:
+                self.update_food_level()
+                now = time.monotonic()
+                if self.food_level is not None:
+                    self.consumption.update(self.food_level, now)
+                    time_to_empty = self.consumption.time_to_empty(self.food_level)
+                    time_to_empty = None if time_to_empty is None else round(time_to_empty)
+                if self.food_level is not None and (
+                    last_reported_level is None
+                    or abs(self.food_level - last_reported_level) > self.food_level_deadband
+                    or self.time_to_empty_changed(last_reported_time_to_empty, time_to_empty)
+                    or now - last_report_time >= self.food_level_heartbeat
+                ):
+                    reporter.update({"foodLevel": self.food_level, "timeToEmpty": time_to_empty})
+                    if history is not None:
+                        history.record(self.food_level, time_to_empty)
+                    last_reported_level = self.food_level
+                    last_reported_time_to_empty = time_to_empty
+                    last_report_time = now
+            except Exception as e:
+                # Keep polling - a failed poll shouldn't stop future ones
+                print(f"Failed to update food level: {e}")
+
+            # Poll faster while birds are feeding, and wake the sensor less often while they aren't
+            interval = self.next_poll_interval(interval)
+            if self.adaptive_polling:
+                measurement_time = TIMING_BUDGET / 1e6
+                self.distance_sensor.set_sample_interval(max(SAMPLE_INTERVAL, interval / SAMPLES_PER_POLL - measurement_time))
+            await asyncio.sleep(interval)
+
+    def sound_alarm(self):
+        return self.alarm.trigger()
 
 
 def get_desired_prop(desired_prop_dict, prop_dict_key, prop_env_key, prop_default):
@@ -104,17 +582,26 @@ def get_desired_prop(desired_prop_dict, prop_dict_key, prop_env_key, prop_defaul
         return os.getenv(prop_env_key, prop_default)
 
 
-async def report_feeder_properties(feeder, client):
+def report_feeder_properties(feeder, reporter):
     report = {
         "distanceConfig": {
             "maxFoodDistance": feeder.max_food_distance,
             "minFoodDistance": feeder.min_food_distance,
             "foodPollInterval": feeder.food_poll_interval,
+            "maxFoodPollInterval": feeder.max_food_poll_interval,
         },
-        "foodLevel": feeder.food_level,
         "unwelcomeVisitors": list(feeder.unwelcome_visitors)
     }
-    await client.patch_twin_reported_properties(report)
+    # A null reported property would delete the last known level, so leave it out until the
+    # sensor has given a reading
+    if feeder.food_level is not None:
+        report["foodLevel"] = feeder.food_level
+    reporter.update(report)
+
+def device_id_from_connection_string(conn_str):
+    """Return the DeviceId field of an IoT Hub device connection string."""
+    fields = dict(field.split("=", 1) for field in conn_str.split(";") if "=" in field)
+    return fields.get("DeviceId")
 
 async def main():
     # connect the client.
@@ -135,14 +622,19 @@ async def main():
         distance_config = {}
     max_food_distance = get_desired_prop(distance_config, "maxFoodDistance", "MAX_FOOD_DIST", MAX_DIST)
     min_food_distance = get_desired_prop(distance_config, "minFoodDistance", "MIN_FOOD_DIST", MIN_DIST)
-    food_poll_interval = get_desired_prop(distance_config, "foodPollInterval", "FOOD_POLL_INT", FOOD_POLL)
+    food_poll_interval = float(get_desired_prop(distance_config, "foodPollInterval", "FOOD_POLL_INT", FOOD_POLL))
+    max_food_poll_interval = float(get_desired_prop(distance_config, "maxFoodPollInterval", "MAX_FOOD_POLL_INT", MAX_FOOD_POLL))
     unwelcome_visitors = get_desired_prop(twin["desired"], "unwelcomeVisitors", "UNWELCOME_VISITORS", UNWELCOME_VISITORS)
     if type(unwelcome_visitors) == str:
         # Got list of unwelcome visitors from environment variable - need to parse into a list
         unwelcome_visitors = unwelcome_visitors.split(",")
 
     # create the feeder object
-    feeder = Feeder(max_food_distance, min_food_distance, food_poll_interval, unwelcome_visitors=unwelcome_visitors)
+    feeder = Feeder(max_food_distance, min_food_distance, food_poll_interval, unwelcome_visitors=unwelcome_visitors,
+                    max_food_poll_interval=max_food_poll_interval)
+
+    # reported property changes are sent together, at most once per flush window
+    reporter = ReportedProperties(device_client)
 
     # define behavior for receiving a twin patch
     # NOTE: this could be a function or a coroutine
@@ -153,13 +645,17 @@ async def main():
                 new_interval = distance_config["foodPollInterval"]
                 print(f"Updating food poll interval to {new_interval}")
                 feeder.set_food_pool_interval(new_interval)
+            if "maxFoodPollInterval" in distance_config:
+                new_interval = distance_config["maxFoodPollInterval"]
+                print(f"Updating maximum food poll interval to {new_interval}")
+                feeder.set_max_food_poll_interval(new_interval)
         if "unwelcomeVisitors" in patch:
             unwelcome_visitors = patch["unwelcomeVisitors"]
             print(f"Updating unwelcome visitors to {unwelcome_visitors}")
             feeder.set_unwelcome_visitors(unwelcome_visitors)
         else:
             print("Updating unknown desired property.")
-        await report_feeder_properties(feeder, device_client)
+        report_feeder_properties(feeder, reporter)
 
     # set the twin patch handler on the client
     device_client.on_twin_desired_properties_patch_received = twin_patch_handler
@@ -170,15 +666,19 @@ async def main():
         if method_request.name == "checkIfVisitorUnwelcome":
             object = method_request.payload
             if not set(object).isdisjoint(feeder.unwelcome_visitors):
-                # Unwelcome visitor - sound the alarm
-                data = "Visitor unwelcome - sounding alarm"
-                print(f"Sounding alarm at {datetime.datetime.today()}")
-                #asyncio.create_task(feeder.sound_alarm())
+                # Unwelcome visitor - sound the alarm in the background and respond straight away
+                alarm_state = feeder.sound_alarm()
+                data = f"Visitor unwelcome - alarm {alarm_state}"
+                print(f"Visitor unwelcome - alarm {alarm_state} at {datetime.datetime.today()}")
             else:
                 # Visitor not unwelcome - do nothing
                 data = "Visitor not unwelcome - not sounding alarm"
                 print(f"Visitor not unwelcome - not sounding alarm at {datetime.datetime.today()}")
-            payload = {"result": True, "data": data}
+            payload = {"result": True, "data": data, "alarm": feeder.alarm.status()}
+            status = 200  # set return status code
+        elif method_request.name == "silenceAlarm":
+            feeder.alarm.cancel()
+            payload = {"result": True, "data": "Silencing alarm", "alarm": feeder.alarm.status()}
             status = 200  # set return status code
         else:
             payload = {"result": False, "data": "unknown method"}  # set response payload
@@ -191,11 +691,16 @@ async def main():
     # Set the method request handler on the client
     device_client.on_method_request_received = method_request_handler
 
+    # store food levels measured while offline and send them on reconnection
+    history = StoreAndForward(device_client, TelemetryBuffer(), device_id_from_connection_string(conn_str))
+    device_client.on_connection_state_change = history.on_connection_state_change
+    forwarding = asyncio.create_task(history.run())
+
     # report current properties
-    await report_feeder_properties(feeder, device_client)
+    report_feeder_properties(feeder, reporter)
 
     # start periodic updates
-    periodic_updates = asyncio.create_task(feeder.send_periodic_food_level_updates(device_client))
+    periodic_updates = asyncio.create_task(feeder.send_periodic_food_level_updates(reporter, history))
 
     # define behavior for halting the application
     def stdin_listener():
@@ -214,6 +719,11 @@ async def main():
 
     # Stop the periodic updates
     periodic_updates.cancel()
+    forwarding.cancel()
+    feeder.alarm.cancel()
+    feeder.distance_sensor.stop()
+    await reporter.flush()
+    history.buffer.close()
 
     # Finally, shut down the client
     await device_client.shutdown()